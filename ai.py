@@ -6,15 +6,27 @@ ai.py — Geração de copy A/B com regras de marketing e saída estruturada.
 """
 from __future__ import annotations
 
+import hashlib
 import json
 import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Any, Dict, List, Optional
 try:
     from typing import Annotated  # Py3.9+
 except ImportError:  # pragma: no cover
     from typing_extensions import Annotated  # fallback
+try:
+    import orjson as _json_fast  # opcional: parse em C, mais rápido
+except ImportError:  # pragma: no cover
+    _json_fast = json
+try:
+    import msgspec  # opcional: decode+validação em C, bem mais rápido que pydantic
+except ImportError:  # pragma: no cover
+    msgspec = None
 
-from pydantic import BaseModel, ValidationError, Field
+from pydantic import BaseModel, ValidationError, Field, PrivateAttr, TypeAdapter
 
 class IAItem(BaseModel):
     itemId: int
@@ -24,130 +36,430 @@ class IAItem(BaseModel):
 
 class IAResponse(BaseModel):
     analise_de_produtos: List[IAItem]
+    # True quando é o fallback local (IA falhou ou resposta ilegível): não deve ir para caches
+    _fallback: bool = PrivateAttr(default=False)
 
-def _extract_json_blocks(text: str) -> List[str]:
-    blocks: List[str] = []
-    if not text:
-        return blocks
+def is_fallback(resp: Any) -> bool:
+    return bool(getattr(resp, "_fallback", False))
+
+if msgspec is not None:
+    class _IAItemS(msgspec.Struct):
+        itemId: int
+        pontuacao: Annotated[int, msgspec.Meta(ge=0, le=100)]
+        texto_de_venda_a: str
+        texto_de_venda_b: str
+
+    class _IAResponseS(msgspec.Struct):
+        analise_de_produtos: List[_IAItemS]
+
+    _MS_DECODER: Any = msgspec.json.Decoder(_IAResponseS)
+else:  # pragma: no cover
+    _MS_DECODER = None
+
+def _decode_msgspec(s: str) -> Optional[IAResponse]:
+    """Decodifica com msgspec (modo estrito) e converte para os tipos pydantic públicos.
+    Retorna None se msgspec não estiver instalado ou se o payload precisar do modo tolerante."""
+    if _MS_DECODER is None:
+        return None
+    try:
+        r = _MS_DECODER.decode(s)
+    except msgspec.DecodeError:
+        return None
+    return IAResponse.model_construct(analise_de_produtos=[
+        IAItem.model_construct(
+            itemId=it.itemId, pontuacao=it.pontuacao,
+            texto_de_venda_a=it.texto_de_venda_a, texto_de_venda_b=it.texto_de_venda_b,
+        )
+        for it in r.analise_de_produtos
+    ])
+
+# validador de item criado uma vez só; permite aproveitar itens válidos de respostas parciais
+_ITEM_ADAPTER: TypeAdapter[IAItem] = TypeAdapter(IAItem)
+
+# Cache em memória (LRU) de respostas já validadas: chave = hash do prompt/lista compacta
+_CACHE_MAX = 256
+_IA_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_IA_CACHE_LOCK = threading.Lock()
+
+def _fingerprint(obj: Any) -> str:
+    raw = obj if isinstance(obj, str) else json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _cache_get(key: str) -> Optional[IAResponse]:
+    with _IA_CACHE_LOCK:
+        hit = _IA_CACHE.get(key)
+        if hit is None:
+            return None
+        _IA_CACHE.move_to_end(key)
+    return IAResponse.model_validate_json(hit)
+
+def _cache_put(key: str, resp: IAResponse) -> None:
+    dumped = resp.model_dump_json()
+    with _IA_CACHE_LOCK:
+        _IA_CACHE[key] = dumped
+        _IA_CACHE.move_to_end(key)
+        while len(_IA_CACHE) > _CACHE_MAX:
+            _IA_CACHE.popitem(last=False)
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+def _largest_json_block(text: str) -> Optional[str]:
+    """Maior bloco {...} de nível superior (ignora chaves dentro de strings), sem lista intermediária.
+    Pula direto entre `{`, `}` e `"` com str.find: o laço Python só roda por delimitador."""
+    if not text or "{" not in text:
+        return None
+    best_start = best_end = 0
+    find = text.find
+    n = len(text)
+    nxt_open = nxt_close = nxt_quote = -2  # -2 = ainda não procurado
+    i = 0
     depth = 0
-    start = None
-    for i, ch in enumerate(text):
-        if ch == '{':
-            if depth == 0:
-                start = i
+    start = -1
+    while i < n:
+        if depth == 0:
+            start = find("{", i)
+            if start == -1:
+                break
+            depth = 1
+            i = start + 1
+            continue
+        if nxt_open != -1 and nxt_open < i:
+            nxt_open = find("{", i)
+        if nxt_close != -1 and nxt_close < i:
+            nxt_close = find("}", i)
+        if nxt_quote != -1 and nxt_quote < i:
+            nxt_quote = find('"', i)
+        pos = n
+        if nxt_open != -1:
+            pos = nxt_open
+        if nxt_close != -1 and nxt_close < pos:
+            pos = nxt_close
+        if nxt_quote != -1 and nxt_quote < pos:
+            pos = nxt_quote
+        if pos == n:
+            break
+        if pos == nxt_quote:
+            end = find('"', pos + 1)
+            while end != -1:
+                b = end - 1
+                while text[b] == "\\":
+                    b -= 1
+                if (end - 1 - b) % 2 == 0:
+                    break
+                end = find('"', end + 1)
+            if end == -1:
+                break
+            i = end + 1
+        elif pos == nxt_open:
             depth += 1
-        elif ch == '}':
-            if depth > 0:
-                depth -= 1
-                if depth == 0 and start is not None:
-                    blocks.append(text[start:i+1])
-                    start = None
-    return blocks
+            i = pos + 1
+        else:
+            depth -= 1
+            i = pos + 1
+            if depth == 0 and i - start > best_end - best_start:
+                best_start, best_end = start, i
+    return text[best_start:best_end] if best_end else None
+
+class _JsonStreamWatcher:
+    """Versão incremental do scanner: acumula pedaços do stream e avisa quando
+    fecha um bloco de nível superior que contém `analise_de_produtos`."""
+    __slots__ = ("parts", "pos", "depth", "start", "in_string", "escaped")
+
+    def __init__(self) -> None:
+        self.parts: List[str] = []
+        self.pos = 0
+        self.depth = 0
+        self.start = -1
+        self.in_string = False
+        self.escaped = False
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def feed(self, chunk: str) -> bool:
+        self.parts.append(chunk)
+        base = self.pos
+        self.pos += len(chunk)
+        done = False
+        for i, ch in enumerate(chunk, base):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                if self.depth > 0:
+                    self.in_string = True
+            elif ch == '{':
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+            elif ch == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0 and "analise_de_produtos" in self.text()[self.start:i+1]:
+                    done = True
+        return done
 
 def largest_json_block(text: str) -> Optional[str]:
-    blocks = _extract_json_blocks(text or "")
-    if not blocks:
-        return None
-    return max(blocks, key=len)
+    return _largest_json_block(text or "")
 
 def try_parse_ia(text: str) -> Optional[IAResponse]:
     if not text:
         return None
-    candidate = largest_json_block(text)
-    if not candidate:
-        return None
 
     def _attempt(s: str) -> Optional[IAResponse]:
+        # Caminho rápido: valida direto do texto (uma passada, sem dict intermediário)
+        if '"texto_de_venda"' not in s or '"texto_de_venda_a"' in s:
+            fast = _decode_msgspec(s)
+            if fast is not None:
+                return fast
+            try:
+                return IAResponse.model_validate_json(s)
+            except ValidationError:
+                pass  # tenta salvar os itens válidos abaixo
         try:
-            data = json.loads(s)
+            data = _json_fast.loads(s)
         except Exception:
             return None
-        try:
-            if isinstance(data, dict) and "analise_de_produtos" in data:
-                for it in data["analise_de_produtos"]:
-                    if "texto_de_venda" in it and ("texto_de_venda_a" not in it or "texto_de_venda_b" not in it):
-                        it["texto_de_venda_a"] = it.get("texto_de_venda")
-                        it["texto_de_venda_b"] = it.get("texto_de_venda")
-            return IAResponse.model_validate(data)
-        except ValidationError:
+        raw_items = data.get("analise_de_produtos") if isinstance(data, dict) else None
+        if not isinstance(raw_items, list):
             return None
+        items: List[IAItem] = []
+        for it in raw_items:
+            if isinstance(it, dict) and "texto_de_venda" in it and ("texto_de_venda_a" not in it or "texto_de_venda_b" not in it):
+                it["texto_de_venda_a"] = it.get("texto_de_venda")
+                it["texto_de_venda_b"] = it.get("texto_de_venda")
+            try:
+                items.append(_ITEM_ADAPTER.validate_python(it))
+            except ValidationError:
+                continue
+        if raw_items and not items:
+            return None
+        return IAResponse.model_construct(analise_de_produtos=items)
+
+    stripped = text.strip()
+    if stripped[:1] == "{" and stripped[-1:] == "}":
+        # modo JSON: a resposta já é o objeto inteiro, dispensa o scanner
+        parsed = _attempt(stripped)
+        if parsed:
+            return parsed
+
+    candidate = largest_json_block(text)
+    if not candidate:
+        return None
 
-    parsed = _attempt(candidate)
+    parsed = _attempt(candidate) if candidate != stripped else None
     if parsed:
         return parsed
 
-    sanitized = re.sub(r",\s*([}\]])", r"\1", candidate)
+    sanitized = _TRAILING_COMMA_RE.sub(r"\1", candidate)
     return _attempt(sanitized)
 
-def call_gemini(prompt: str, *, model: str = "gemini-1.5-flash", api_key: Optional[str] = None) -> str:
+# Modo JSON nativo do Gemini: saída já estruturada, sem prosa em volta
+_IA_RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "analise_de_produtos": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "itemId": {"type": "INTEGER"},
+                    "pontuacao": {"type": "INTEGER"},
+                    "texto_de_venda_a": {"type": "STRING"},
+                    "texto_de_venda_b": {"type": "STRING"},
+                },
+                "required": ["itemId", "pontuacao", "texto_de_venda_a", "texto_de_venda_b"],
+            },
+        },
+    },
+    "required": ["analise_de_produtos"],
+}
+_JSON_GENERATION_CONFIG: Dict[str, Any] = {
+    "response_mime_type": "application/json",
+    "response_schema": _IA_RESPONSE_SCHEMA,
+}
+
+_genai: Any = None
+
+def _lazy_genai() -> Any:
+    """Importa google.generativeai uma única vez (import pesado, adiado até o primeiro uso)."""
+    global _genai
+    if _genai is None:
+        try:
+            import google.generativeai as genai
+        except ImportError as e:  # pragma: no cover
+            raise RuntimeError("Pacote google-generativeai não instalado. `pip install google-generativeai`") from e
+        _genai = genai
+    return _genai
+
+def preload() -> bool:
+    """Aquece o import do SDK no início do processo. Retorna False se o pacote não estiver instalado."""
+    try:
+        _lazy_genai()
+        return True
+    except RuntimeError:
+        return False
+
+@lru_cache(maxsize=8)
+def _get_model(model: str, api_key: str) -> Any:
+    genai = _lazy_genai()
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model)
+
+def call_gemini(
+    prompt: str,
+    *,
+    model: str = "gemini-1.5-flash",
+    api_key: Optional[str] = None,
+    stream: bool = False,
+    json_mode: bool = False,
+) -> str:
+    """Chama o Gemini. Com stream=True, para de consumir a resposta assim que o
+    JSON principal fecha (não paga tokens/bytes de texto extra após o `}`).
+    Com json_mode=True, pede saída application/json no esquema de IAResponse."""
     if api_key is None:
         import os
         api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY não configurada.")
+    gmodel = _get_model(model, api_key)
+    kwargs: Dict[str, Any] = {"generation_config": _JSON_GENERATION_CONFIG} if json_mode else {}
     try:
-        import google.generativeai as genai
-    except ImportError as e:  # pragma: no cover
-        raise RuntimeError("Pacote google-generativeai não instalado. `pip install google-generativeai`") from e
-    genai.configure(api_key=api_key)
-    gmodel = genai.GenerativeModel(model)
-    resp = gmodel.generate_content(prompt)
-    return getattr(resp, "text", None) or ""
-
-def analyze_products(products: List[Dict[str, Any]], *, model: str = "gemini-1.5-flash", api_key: Optional[str] = None) -> IAResponse:
-    compact: List[Dict[str, Any]] = []
-    for p in products:
-        compact.append({
-            "itemId": p.get("itemId") or p.get("item_id"),
-            "name": p.get("productName") or p.get("name") or p.get("itemName"),
-            "ratingStar": p.get("ratingStar") or p.get("rating"),
-            "sales": p.get("sales"),
-            "priceMin": p.get("priceMin"),
-            "priceMax": p.get("priceMax"),
-            "discountRate": p.get("priceDiscountRate") or p.get("discount"),
-            "link": p.get("productLink") or p.get("link") or p.get("offerLink"),
-            "hint": p.get("hint"),
-        })
-
-    system = (
-        "Você é um copywriter de ofertas (pt-BR). "
-        "Responda SOMENTE em JSON válido no esquema:\n"
-        "{ \"analise_de_produtos\": [ { \"itemId\": int, \"pontuacao\": 0-100, "
-        "\"texto_de_venda_a\": str, \"texto_de_venda_b\": str } ] }\n\n"
-        "Regras de copy:\n"
-        "- Diga claramente o que é o produto usando o NOME recebido.\n"
-        "- NÃO mencione preço, porcentagem de desconto, rating/avaliações, nem número de vendas.\n"
-        "- 100–160 caracteres. Sem emojis e sem links.\n"
-        "- Use até UMA especificação concreta se fizer sentido (campo 'hint': '2400 DPI', 'IP67', '4L', 'rotação 360°').\n"
-        "- Evite termos vagos como 'premium', 'incrível'; prefira benefícios objetivos e uso real.\n"
-        "- Gere DUAS variações: A (benefício principal) e B (urgência leve)."
-    )
-    user = f"Produtos:\n{json.dumps(compact, ensure_ascii=False)}\nRetorne SOMENTE JSON (sem texto fora do JSON)."
-    prompt = f"{system}\n\n{user}"
+        resp = gmodel.generate_content(prompt, stream=stream, **kwargs)
+    except (TypeError, ValueError):
+        if not kwargs:
+            raise
+        # SDK antigo sem response_schema: segue sem modo JSON (o parser tolerante cobre)
+        resp = gmodel.generate_content(prompt, stream=stream)
+    if not stream:
+        return getattr(resp, "text", None) or ""
+    watcher = _JsonStreamWatcher()
+    for chunk in resp:
+        try:
+            piece = chunk.text
+        except Exception:  # chunk sem texto (ex.: bloqueado/finish_reason)
+            continue
+        if piece and watcher.feed(piece):
+            break
+    return watcher.text()
+
+SYSTEM_PROMPT = (
+    "Você é um copywriter de ofertas (pt-BR). "
+    "Responda SOMENTE em JSON válido no esquema:\n"
+    "{ \"analise_de_produtos\": [ { \"itemId\": int, \"pontuacao\": 0-100, "
+    "\"texto_de_venda_a\": str, \"texto_de_venda_b\": str } ] }\n\n"
+    "Regras de copy:\n"
+    "- Diga claramente o que é o produto usando o NOME recebido.\n"
+    "- NÃO mencione preço, porcentagem de desconto, rating/avaliações, nem número de vendas.\n"
+    "- 100–160 caracteres. Sem emojis e sem links.\n"
+    "- Use até UMA especificação concreta se fizer sentido (campo 'hint': '2400 DPI', 'IP67', '4L', 'rotação 360°').\n"
+    "- Evite termos vagos como 'premium', 'incrível'; prefira benefícios objetivos e uso real.\n"
+    "- Gere DUAS variações: A (benefício principal) e B (urgência leve)."
+)
+REPAIR_SUFFIX = "\n\nO JSON anterior estava inválido. Gere novamente, estritamente válido, sem comentários.\n"
+
+_FB_A = ": benefício claro para o dia a dia."
+_FB_B = ": solução prática com ótimo desempenho."
+
+# campo de saída -> chaves aceitas na entrada (primeira "truthy" vence, como em `a or b or c`)
+_COMPACT_FIELDS = (
+    ("itemId", ("itemId", "item_id")),
+    ("name", ("productName", "name", "itemName")),
+    ("ratingStar", ("ratingStar", "rating")),
+    ("sales", ("sales",)),
+    ("priceMin", ("priceMin",)),
+    ("priceMax", ("priceMax",)),
+    ("discountRate", ("priceDiscountRate", "discount")),
+    ("link", ("productLink", "link", "offerLink")),
+    ("hint", ("hint",)),
+)
+
+def _first_of(p: Dict[str, Any], keys: tuple) -> Any:
+    v = None
+    for k in keys:
+        v = p.get(k)
+        if v:
+            break
+    return v
+
+# Tabela TSV para o prompt: cabeçalho uma vez só em vez de repetir as chaves em cada produto.
+# (o link fica de fora: a copy não pode citar links e ele é a coluna mais longa)
+_TABLE_COLUMNS = (
+    ("id", "itemId"), ("name", "name"), ("rating", "ratingStar"), ("sales", "sales"),
+    ("pmin", "priceMin"), ("pmax", "priceMax"), ("disc", "discountRate"), ("hint", "hint"),
+)
+_TABLE_HEADER = "\t".join(col for col, _ in _TABLE_COLUMNS)
+_TABLE_CELL_CLEAN = str.maketrans({"\t": " ", "\n": " ", "\r": " "})
 
-    raw = call_gemini(prompt, model=model, api_key=api_key)
-    parsed = try_parse_ia(raw)
+def _encode_table(rows: List[Dict[str, Any]]) -> str:
+    lines = [_TABLE_HEADER]
+    for r in rows:
+        lines.append("\t".join(
+            "" if r.get(key) is None else str(r.get(key)).translate(_TABLE_CELL_CLEAN)
+            for _, key in _TABLE_COLUMNS
+        ))
+    return "\n".join(lines)
 
+def _ask_cached(prompt: str, *, model: str, api_key: Optional[str]) -> Optional[IAResponse]:
+    """call_gemini + try_parse_ia com cache por prompt (só guarda respostas válidas)."""
+    key = f"{model}:{_fingerprint(prompt)}"
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    raw = call_gemini(prompt, model=model, api_key=api_key, stream=True, json_mode=True)
+    # sem a chave raiz não há o que validar: evita scanner + pydantic à toa
+    parsed = try_parse_ia(raw) if "analise_de_produtos" in raw else None
+    if parsed:
+        _cache_put(key, parsed)
+    return parsed
+
+def analyze_products(
+    products: List[Dict[str, Any]],
+    *,
+    model: str = "gemini-1.5-flash",
+    api_key: Optional[str] = None,
+    system_prompt: str = SYSTEM_PROMPT,
+) -> IAResponse:
+    compact: List[Dict[str, Any]] = [
+        {out: _first_of(p, keys) for out, keys in _COMPACT_FIELDS} for p in products
+    ]
+
+    products_key = f"{model}:{_fingerprint([system_prompt, compact])}"
+    cached = _cache_get(products_key)
+    if cached is not None:
+        return cached
+
+    user = (
+        "Produtos (TSV; id=itemId, rating=avaliação, sales=vendas, pmin/pmax=preço, "
+        f"disc=desconto 0-1, hint=especificação opcional):\n```\n{_encode_table(compact)}\n```\n"
+        "Retorne SOMENTE JSON (sem texto fora do JSON)."
+    )
+    prompt = "".join((system_prompt, "\n\n", user))
+    repair_prompt = "".join((system_prompt, REPAIR_SUFFIX, user))
+
+    parsed = _ask_cached(prompt, model=model, api_key=api_key)
     if not parsed:
-        repair_prompt = f"{system}\n\nO JSON anterior estava inválido. Gere novamente, estritamente válido, sem comentários.\n{user}"
-        raw2 = call_gemini(repair_prompt, model=model, api_key=api_key)
-        parsed = try_parse_ia(raw2)
+        parsed = _ask_cached(repair_prompt, model=model, api_key=api_key)
 
     if not parsed:
-        fallback: List[Dict[str, Any]] = []
+        # dados montados aqui mesmo (tipos conhecidos): dispensa validação
+        items: List[IAItem] = []
         for p in compact:
             iid = p.get("itemId")
             if not iid:
                 continue
-            name = (p.get("name") or "Oferta").strip()
             hint = p.get("hint")
-            spec = f" — {hint}" if hint else ""
-            fallback.append({
-                "itemId": int(iid),
-                "pontuacao": 60,
-                "texto_de_venda_a": f"{name}{spec}: benefício claro para o dia a dia.",
-                "texto_de_venda_b": f"{name}{spec}: solução prática com ótimo desempenho.",
-            })
-        return IAResponse(analise_de_produtos=[IAItem(**x) for x in fallback])
-
-    return parsed
\ No newline at end of file
+            head = (p.get("name") or "Oferta").strip() + (" — " + str(hint) if hint else "")
+            items.append(IAItem.model_construct(
+                itemId=int(iid), pontuacao=60,
+                texto_de_venda_a=head + _FB_A, texto_de_venda_b=head + _FB_B,
+            ))
+        fallback = IAResponse.model_construct(analise_de_produtos=items)
+        fallback._fallback = True
+        return fallback
+
+    _cache_put(products_key, parsed)
+    return parsed
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 # conversions_sync.py — baixa conversionReport e salva no SQLite + EV materializado
 from __future__ import annotations
-import argparse, os, time, sqlite3, re
-from typing import Any, Dict
+import argparse, os, time, sqlite3, re, queue, threading
+from typing import Any, Dict, Iterator, List, Tuple
 from shopee_monorepo_modules.conversions import make_session, iter_conversion_report
+from shopee_monorepo_modules.sqlite_tuning import apply_pragmas
+
+_MONEY_RE = re.compile(r"[^0-9,\.]+")
 
 def parse_money(s):
     if s is None: return 0.0
-    t = str(s)
-    t = re.sub(r"[^0-9,\.]+", "", t)
+    t = s if isinstance(s, str) else str(s)
+    # caminho rápido: decimal "limpo" como a API costuma mandar ("12.34") — sem regex
+    digits = t.replace(".", "", 1)
+    if digits.isascii() and digits.isdigit():
+        return float(t)
+    t = _MONEY_RE.sub("", t)
     if "," in t and "." not in t:
         t = t.replace(",", ".")
     parts = t.split(".")
@@ -20,6 +27,7 @@ def parse_money(s):
         return 0.0
 
 def ensure_schema(con: sqlite3.Connection):
+    apply_pragmas(con)
     con.executescript("""
     CREATE TABLE IF NOT EXISTS conversions (
       conversion_id       INTEGER PRIMARY KEY,
@@ -67,28 +75,76 @@ def ensure_schema(con: sqlite3.Connection):
       PRIMARY KEY (conversion_id, order_id, item_id, model_id)
     );
     CREATE INDEX IF NOT EXISTS idx_conv_utm ON conversions(utm_content);
-    CREATE INDEX IF NOT EXISTS idx_conv_item ON conversion_items(item_id);
-    CREATE INDEX IF NOT EXISTS idx_conv_shop ON conversion_items(shop_name);
-    CREATE INDEX IF NOT EXISTS idx_conv_cat ON conversion_items(globalCategoryLv1Name);
+    -- índices de cobertura: agregados de EV sem visitar a tabela; substituem os de uma coluna
+    -- (mesmo prefixo), que só custavam escrita a cada sync
+    DROP INDEX IF EXISTS idx_conv_item;
+    DROP INDEX IF EXISTS idx_conv_shop;
+    DROP INDEX IF EXISTS idx_conv_cat;
+    CREATE INDEX IF NOT EXISTS idx_ci_item_cid_amt ON conversion_items(item_id, conversion_id, item_total_commission);
+    CREATE INDEX IF NOT EXISTS idx_ci_shop_cid_amt ON conversion_items(shop_name, conversion_id, item_total_commission);
+    CREATE INDEX IF NOT EXISTS idx_ci_cat_cid_amt ON conversion_items(globalCategoryLv1Name, conversion_id, item_total_commission);
+    -- conversion_id é o rowid (INTEGER PRIMARY KEY): toda entrada de índice já o carrega
+    CREATE INDEX IF NOT EXISTS idx_conv_purchase ON conversions(purchase_time);
     """)
     con.commit()
 
-def upsert_conversion(con: sqlite3.Connection, node: Dict[str, Any]):
-    con.execute("""
-        INSERT INTO conversions(conversion_id, purchase_time, click_time, buyer_type, device,
-                                utm_content, referrer, net_commission, total_commission, campaign_type)
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(conversion_id) DO UPDATE SET
-          purchase_time=excluded.purchase_time,
-          click_time=excluded.click_time,
-          buyer_type=excluded.buyer_type,
-          device=excluded.device,
-          utm_content=excluded.utm_content,
-          referrer=excluded.referrer,
-          net_commission=excluded.net_commission,
-          total_commission=excluded.total_commission,
-          campaign_type=excluded.campaign_type
-    """, (
+UPSERT_CONVERSION_SQL = """
+    INSERT INTO conversions(conversion_id, purchase_time, click_time, buyer_type, device,
+                            utm_content, referrer, net_commission, total_commission, campaign_type)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(conversion_id) DO UPDATE SET
+      purchase_time=excluded.purchase_time,
+      click_time=excluded.click_time,
+      buyer_type=excluded.buyer_type,
+      device=excluded.device,
+      utm_content=excluded.utm_content,
+      referrer=excluded.referrer,
+      net_commission=excluded.net_commission,
+      total_commission=excluded.total_commission,
+      campaign_type=excluded.campaign_type
+"""
+
+UPSERT_ORDER_SQL = """
+    INSERT INTO conversion_orders(conversion_id, order_id, order_status, shop_type)
+    VALUES(?, ?, ?, ?)
+    ON CONFLICT(conversion_id, order_id) DO UPDATE SET
+      order_status=excluded.order_status,
+      shop_type=excluded.shop_type
+"""
+
+UPSERT_ITEM_SQL = """
+    INSERT INTO conversion_items(
+      conversion_id, order_id, item_id, model_id, item_name, qty, actual_amount,
+      item_total_commission, item_seller_commission, item_shopee_commission_capped,
+      item_seller_commission_rate, item_shopee_commission_rate,
+      display_item_status, fraud_status, channel_type, attribution_type,
+      shop_id, shop_name, image_url, complete_time,
+      globalCategoryLv1Name, globalCategoryLv2Name, globalCategoryLv3Name
+    ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(conversion_id, order_id, item_id, model_id) DO UPDATE SET
+      item_name=excluded.item_name,
+      qty=excluded.qty,
+      actual_amount=excluded.actual_amount,
+      item_total_commission=excluded.item_total_commission,
+      item_seller_commission=excluded.item_seller_commission,
+      item_shopee_commission_capped=excluded.item_shopee_commission_capped,
+      item_seller_commission_rate=excluded.item_seller_commission_rate,
+      item_shopee_commission_rate=excluded.item_shopee_commission_rate,
+      display_item_status=excluded.display_item_status,
+      fraud_status=excluded.fraud_status,
+      channel_type=excluded.channel_type,
+      attribution_type=excluded.attribution_type,
+      shop_id=excluded.shop_id,
+      shop_name=excluded.shop_name,
+      image_url=excluded.image_url,
+      complete_time=excluded.complete_time,
+      globalCategoryLv1Name=excluded.globalCategoryLv1Name,
+      globalCategoryLv2Name=excluded.globalCategoryLv2Name,
+      globalCategoryLv3Name=excluded.globalCategoryLv3Name
+"""
+
+def conversion_row(node: Dict[str, Any]) -> Tuple:
+    return (
         int(node.get("conversionId")),
         int(node.get("purchaseTime") or 0) or None,
         int(node.get("clickTime") or 0) or None,
@@ -99,108 +155,160 @@ def upsert_conversion(con: sqlite3.Connection, node: Dict[str, Any]):
         parse_money(node.get("netCommission")),
         parse_money(node.get("totalCommission")),
         node.get("campaignType"),
-    ))
+    )
 
-def upsert_orders_items(con: sqlite3.Connection, node: Dict[str, Any]):
-    cid = int(node.get("conversionId"))
-    orders = node.get("orders") or []
-    for od in orders:
+def _i(d: Dict[str, Any], k: str) -> int:
+    v = d.get(k)
+    return int(v) if v else 0
+
+def iter_order_rows(node: Dict[str, Any]) -> Iterator[Tuple]:
+    cid = int(node["conversionId"])
+    for od in node.get("orders") or ():
+        yield (cid, str(od.get("orderId")), od.get("orderStatus"), od.get("shopType"))
+
+def iter_item_rows(node: Dict[str, Any]) -> Iterator[Tuple]:
+    """Uma tupla pronta por item (ordem das colunas de UPSERT_ITEM_SQL), sem listas intermediárias."""
+    cid = int(node["conversionId"])
+    for od in node.get("orders") or ():
         oid = str(od.get("orderId"))
-        con.execute("""
-            INSERT INTO conversion_orders(conversion_id, order_id, order_status, shop_type)
-            VALUES(?, ?, ?, ?)
-            ON CONFLICT(conversion_id, order_id) DO UPDATE SET
-              order_status=excluded.order_status,
-              shop_type=excluded.shop_type
-        """, (cid, oid, od.get("orderStatus"), od.get("shopType")))
-        items = od.get("items") or []
-        for it in items:
-            con.execute("""
-                INSERT INTO conversion_items(
-                  conversion_id, order_id, item_id, model_id, item_name, qty, actual_amount,
-                  item_total_commission, item_seller_commission, item_shopee_commission_capped,
-                  item_seller_commission_rate, item_shopee_commission_rate,
-                  display_item_status, fraud_status, channel_type, attribution_type,
-                  shop_id, shop_name, image_url, complete_time,
-                  globalCategoryLv1Name, globalCategoryLv2Name, globalCategoryLv3Name
-                ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ON CONFLICT(conversion_id, order_id, item_id, model_id) DO UPDATE SET
-                  item_name=excluded.item_name,
-                  qty=excluded.qty,
-                  actual_amount=excluded.actual_amount,
-                  item_total_commission=excluded.item_total_commission,
-                  item_seller_commission=excluded.item_seller_commission,
-                  item_shopee_commission_capped=excluded.item_shopee_commission_capped,
-                  item_seller_commission_rate=excluded.item_seller_commission_rate,
-                  item_shopee_commission_rate=excluded.item_shopee_commission_rate,
-                  display_item_status=excluded.display_item_status,
-                  fraud_status=excluded.fraud_status,
-                  channel_type=excluded.channel_type,
-                  attribution_type=excluded.attribution_type,
-                  shop_id=excluded.shop_id,
-                  shop_name=excluded.shop_name,
-                  image_url=excluded.image_url,
-                  complete_time=excluded.complete_time,
-                  globalCategoryLv1Name=excluded.globalCategoryLv1Name,
-                  globalCategoryLv2Name=excluded.globalCategoryLv2Name,
-                  globalCategoryLv3Name=excluded.globalCategoryLv3Name
-            """, (
+        for it in od.get("items") or ():
+            get = it.get
+            yield (
                 cid, oid,
-                int(it.get("itemId") or 0), int(it.get("modelId") or 0),
-                it.get("itemName"),
-                int(it.get("qty") or 0),
-                parse_money(it.get("actualAmount")),
-                parse_money(it.get("itemTotalCommission")),
-                parse_money(it.get("itemSellerCommission")),
-                parse_money(it.get("itemShopeeCommissionCapped")),
-                parse_money(it.get("itemSellerCommissionRate")),
-                parse_money(it.get("itemShopeeCommissionRate")),
-                it.get("displayItemStatus"),
-                it.get("fraudStatus"),
-                it.get("channelType"),
-                it.get("attributionType"),
-                int(it.get("shopId") or 0),
-                it.get("shopName"),
-                it.get("imageUrl"),
-                int(it.get("completeTime") or 0) or None,
-                it.get("globalCategoryLv1Name"),
-                it.get("globalCategoryLv2Name"),
-                it.get("globalCategoryLv3Name"),
-            ))
+                _i(it, "itemId"), _i(it, "modelId"),
+                get("itemName"),
+                _i(it, "qty"),
+                parse_money(get("actualAmount")),
+                parse_money(get("itemTotalCommission")),
+                parse_money(get("itemSellerCommission")),
+                parse_money(get("itemShopeeCommissionCapped")),
+                parse_money(get("itemSellerCommissionRate")),
+                parse_money(get("itemShopeeCommissionRate")),
+                get("displayItemStatus"),
+                get("fraudStatus"),
+                get("channelType"),
+                get("attributionType"),
+                _i(it, "shopId"),
+                get("shopName"),
+                get("imageUrl"),
+                _i(it, "completeTime") or None,
+                get("globalCategoryLv1Name"),
+                get("globalCategoryLv2Name"),
+                get("globalCategoryLv3Name"),
+            )
+
+def upsert_conversion(con: sqlite3.Connection, node: Dict[str, Any]):
+    con.execute(UPSERT_CONVERSION_SQL, conversion_row(node))
+
+def upsert_orders_items(con: sqlite3.Connection, node: Dict[str, Any]):
+    con.executemany(UPSERT_ORDER_SQL, iter_order_rows(node))
+    con.executemany(UPSERT_ITEM_SQL, iter_item_rows(node))
+
+class BatchWriter:
+    """Acumula linhas de vários nós e grava tudo com executemany numa única transação por lote."""
+    def __init__(self, con: sqlite3.Connection, batch_nodes: int = 500):
+        self.con = con
+        self.batch_nodes = max(1, int(batch_nodes))
+        self.conv_rows: List[Tuple] = []
+        self.order_rows: List[Tuple] = []
+        self.item_rows: List[Tuple] = []
+
+    def add(self, node: Dict[str, Any]) -> None:
+        self.conv_rows.append(conversion_row(node))
+        self.order_rows.extend(iter_order_rows(node))
+        self.item_rows.extend(iter_item_rows(node))
+        if len(self.conv_rows) >= self.batch_nodes:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.conv_rows:
+            return
+        with self.con:  # BEGIN ... COMMIT (ROLLBACK em erro)
+            self.con.executemany(UPSERT_CONVERSION_SQL, self.conv_rows)
+            self.con.executemany(UPSERT_ORDER_SQL, self.order_rows)
+            self.con.executemany(UPSERT_ITEM_SQL, self.item_rows)
+        self.conv_rows.clear()
+        self.order_rows.clear()
+        self.item_rows.clear()
+
+# Reconstrução das tabelas EV num único script/transação: o SQLite prepara tudo de uma vez e
+# quem lê nunca vê as tabelas no meio da troca. {cutoff} é sempre um int (formatado com int()).
+EV_REBUILD_SQL = """
+BEGIN IMMEDIATE;
+DROP TABLE IF EXISTS ev_item_agg;
+DROP TABLE IF EXISTS ev_shop_agg;
+DROP TABLE IF EXISTS ev_cat_agg;
+DROP TABLE IF EXISTS ev_item_cat;
+
+CREATE TABLE ev_item_agg AS
+SELECT ci.item_id AS key, COALESCE(SUM(ci.item_total_commission),0.0) AS ev_sum
+FROM conversion_items ci
+JOIN conversions c ON c.conversion_id = ci.conversion_id
+WHERE (c.purchase_time IS NULL OR c.purchase_time >= {cutoff})
+GROUP BY ci.item_id;
+
+CREATE TABLE ev_shop_agg AS
+SELECT ci.shop_name AS key, COALESCE(SUM(ci.item_total_commission),0.0) AS ev_sum
+FROM conversion_items ci
+JOIN conversions c ON c.conversion_id = ci.conversion_id
+WHERE (c.purchase_time IS NULL OR c.purchase_time >= {cutoff})
+GROUP BY ci.shop_name;
+
+CREATE TABLE ev_cat_agg AS
+SELECT ci.globalCategoryLv1Name AS key, COALESCE(SUM(ci.item_total_commission),0.0) AS ev_sum
+FROM conversion_items ci
+JOIN conversions c ON c.conversion_id = ci.conversion_id
+WHERE (c.purchase_time IS NULL OR c.purchase_time >= {cutoff})
+GROUP BY ci.globalCategoryLv1Name;
+
+-- categoria dominante de cada item (evita GROUP BY + sort por consulta em compute_ev_signal)
+CREATE TABLE ev_item_cat AS
+SELECT item_id, cat FROM (
+    SELECT item_id, globalCategoryLv1Name AS cat,
+           ROW_NUMBER() OVER (PARTITION BY item_id
+                              ORDER BY COUNT(*) DESC, globalCategoryLv1Name) AS rn
+    FROM conversion_items
+    GROUP BY item_id, globalCategoryLv1Name
+) WHERE rn = 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_ev_item_cat ON ev_item_cat(item_id);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_ev_item_key ON ev_item_agg(key);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_ev_shop_key ON ev_shop_agg(key);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_ev_cat_key ON ev_cat_agg(key);
+COMMIT;
+"""
 
 def rebuild_ev_tables(con: sqlite3.Connection, window_days: int = 28):
-    cutoff = int(time.time()) - window_days * 86400
-    cur = con.cursor()
-    cur.executescript("""
-        DROP TABLE IF EXISTS ev_item_agg;
-        DROP TABLE IF EXISTS ev_shop_agg;
-        DROP TABLE IF EXISTS ev_cat_agg;
-    """)
-    cur.execute("""
-        CREATE TABLE ev_item_agg AS
-        SELECT ci.item_id AS key, COALESCE(SUM(ci.item_total_commission),0.0) AS ev_sum
-        FROM conversion_items ci
-        JOIN conversions c ON c.conversion_id = ci.conversion_id
-        WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
-        GROUP BY ci.item_id
-    """, (cutoff,))
-    cur.execute("""
-        CREATE TABLE ev_shop_agg AS
-        SELECT ci.shop_name AS key, COALESCE(SUM(ci.item_total_commission),0.0) AS ev_sum
-        FROM conversion_items ci
-        JOIN conversions c ON c.conversion_id = ci.conversion_id
-        WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
-        GROUP BY ci.shop_name
-    """, (cutoff,))
-    cur.execute("""
-        CREATE TABLE ev_cat_agg AS
-        SELECT ci.globalCategoryLv1Name AS key, COALESCE(SUM(ci.item_total_commission),0.0) AS ev_sum
-        FROM conversion_items ci
-        JOIN conversions c ON c.conversion_id = ci.conversion_id
-        WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
-        GROUP BY ci.globalCategoryLv1Name
-    """, (cutoff,))
-    con.commit()
+    cutoff = int(time.time()) - int(window_days) * 86400
+    con.execute("PRAGMA wal_autocheckpoint=10000")
+    try:
+        con.executescript(EV_REBUILD_SQL.format(cutoff=int(cutoff)))
+    except sqlite3.Error:
+        if con.in_transaction:
+            con.rollback()
+        raise
+
+SYNC_BATCH_NODES = 1000
+_SENTINEL = object()
+
+def _produce_batches(q: "queue.Queue", session, partner_id: int, api_key: str,
+                     windows: List[Dict[str, int]], batch_nodes: int = SYNC_BATCH_NODES) -> None:
+    """Baixa as janelas do conversionReport e enfileira lotes de nós; sempre termina com _SENTINEL.
+    Erros vão para a fila para o consumidor relançar na thread principal."""
+    try:
+        batch: List[Dict[str, Any]] = []
+        for window in windows:
+            for node in iter_conversion_report(session, partner_id, api_key, limit=500, **window):
+                batch.append(node)
+                if len(batch) >= batch_nodes:
+                    q.put(batch)
+                    batch = []
+        if batch:
+            q.put(batch)
+    except BaseException as e:
+        q.put(e)
+    finally:
+        q.put(_SENTINEL)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -220,20 +328,34 @@ def main():
 
     session = make_session()
     now = int(time.time())
+    windows = [
+        # 1) Últimas 24h por purchaseTime
+        dict(purchase_start=now - args.purchase_days * 86400, purchase_end=now),
+        # 2) Últimos 7 dias por completeTime
+        dict(complete_start=now - args.complete_days * 86400, complete_end=now),
+    ]
+
+    # Produtor (HTTP) numa thread, consumidor (SQLite) aqui: download e commit se sobrepõem.
+    q: "queue.Queue" = queue.Queue(maxsize=8)
+    producer = threading.Thread(
+        target=_produce_batches,
+        args=(q, session, args.partner_id, args.api_key, windows),
+        daemon=True,
+    )
+    producer.start()
 
-    # 1) Últimas 24h por purchaseTime
-    p_start = now - args.purchase_days * 86400
-    for node in iter_conversion_report(session, args.partner_id, args.api_key,
-                                       purchase_start=p_start, purchase_end=now, limit=500):
-        upsert_conversion(con, node)
-        upsert_orders_items(con, node)
-
-    # 2) Últimos 7 dias por completeTime
-    c_start = now - args.complete_days * 86400
-    for node in iter_conversion_report(session, args.partner_id, args.api_key,
-                                       complete_start=c_start, complete_end=now, limit=500):
-        upsert_conversion(con, node)
-        upsert_orders_items(con, node)
+    writer = BatchWriter(con, batch_nodes=SYNC_BATCH_NODES)
+    while True:
+        batch = q.get()
+        if batch is _SENTINEL:
+            break
+        if isinstance(batch, BaseException):
+            producer.join()
+            raise batch
+        for node in batch:
+            writer.add(node)
+    writer.flush()
+    producer.join()
 
     rebuild_ev_tables(con, window_days=28)
     con.commit()
@@ -1,12 +1,45 @@
 
 from __future__ import annotations
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+try:
+    import numpy as np  # opcional: ranking vetorizado
+except ImportError:  # pragma: no cover
+    np = None
 
 def compute_final_score(ia_score: float, discount_rate: Optional[float], shop_trust: bool) -> float:
     d = max(0.0, min(1.0, (discount_rate or 0.0)))
     trust = 1.0 if shop_trust else 0.0
     return 0.6*ia_score + 0.25*(d*100.0) + 0.15*(trust*100.0)
 
+def quality_mask(ratings: Sequence[float], sales: Sequence[int], discounts: Sequence[float], *,
+                 min_rating: float, min_sales: int, min_discount: float) -> List[bool]:
+    """Filtro de qualidade (rating/vendas/desconto mínimos) sobre colunas já convertidas.
+    Fica em Python puro: converter três listas para arrays custa mais do que a própria comparação."""
+    return [r >= min_rating and s >= min_sales and d >= min_discount
+            for r, s, d in zip(ratings, sales, discounts)]
+
+def _final_np(ia, disc, ev):
+    """Kernel elementar da nota final (arrays float64); mesma fórmula do fallback em Python."""
+    return 0.45 * (ia / 100.0) + 0.25 * np.minimum(np.maximum(disc, 0.0), 1.0) + 0.30 * ev
+
+def rank_desc(ia_scores: Sequence[float], discount_rates: Sequence[float], ev_signals: Sequence[float]) -> List[Tuple[int, float]]:
+    """Nota final 0.45*IA/100 + 0.25*desconto(0..1) + 0.30*EV e ordem decrescente estável.
+    Retorna (índice original, nota) do melhor para o pior."""
+    if not ia_scores:
+        return []
+    if np is None:
+        final = [0.45 * (i / 100.0) + 0.25 * max(0.0, min(1.0, d)) + 0.30 * e
+                 for i, d, e in zip(ia_scores, discount_rates, ev_signals)]
+        order = sorted(range(len(final)), key=final.__getitem__, reverse=True)
+        return [(k, final[k]) for k in order]
+    final = _final_np(
+        np.asarray(ia_scores, dtype=np.float64),
+        np.asarray(discount_rates, dtype=np.float64),
+        np.asarray(ev_signals, dtype=np.float64),
+    )
+    order = np.argsort(-final, kind="stable")
+    return list(zip(order.tolist(), final[order].tolist()))
+
 def is_trusted_shop(shop_id: Optional[int], trusted_ids: Iterable[int]) -> bool:
     try: return int(shop_id) in set(int(x) for x in trusted_ids)
     except Exception: return False
@@ -4,20 +4,26 @@ from __future__ import annotations
 import os
 import sys
 import time
-import json
+import hashlib
 import logging
 import random
 import re
-from typing import Any, Dict, List, Optional, Tuple
+import sqlite3
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Tuple
 
 import requests
 
-from ai import analyze_products, IAResponse  # type: ignore
+from ai import analyze_products, IAResponse, SYSTEM_PROMPT, is_fallback, preload as ai_preload  # type: ignore
 from shopee_monorepo_modules.publisher import TelegramPublisher  # type: ignore
-from shopee_monorepo_modules.ev_signal import compute_ev_signal  # type: ignore
-from shopee_monorepo_modules.shopee_client import ShopeeClient  # <— NOVO
+from shopee_monorepo_modules.ev_signal import compute_ev_signals_bulk  # type: ignore
+from shopee_monorepo_modules.shopee_client import OfferPage, ShopeeClient  # <— NOVO
 from rescue_publish import publish_with_rescue  # type: ignore
-from storage import Storage  # type: ignore
+from storage import Storage, cooldown_ok  # type: ignore
+from scoring import quality_mask, rank_desc  # type: ignore
 
 try:
     from config_keywords import resolve_meta as kw_resolve_meta  # type: ignore
@@ -35,6 +41,12 @@ GENERIC_TOKENS = [
     r"\bfrete\s*grátis\b", r"\baproveite\b", r"\boferta\b", r"\bdesconto\b",
 ]
 
+# uma passada só (alternação compilada) em vez de um re.sub por token
+_GENERIC_RE = re.compile("|".join(GENERIC_TOKENS), re.I)
+_MULTISPACE_RE = re.compile(r"\s{2,}")
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+_CTA_COPY_RE = re.compile(r"\b(aproveite|compre\s*agora|garanta\s*(o|a)\s*sua?)\b", re.I)
+
 def getenv_required(name: str) -> str:
     v = os.getenv(name, "").strip()
     if not v:
@@ -57,30 +69,37 @@ def getenv_bool(name: str, default: bool = False) -> bool:
     v = str(os.getenv(name, str(int(default)))).strip().lower()
     return v in ("1", "true", "yes", "y", "sim")
 
+# nomes se repetem entre seleção e publicação; funções puras, cache por nome
+@lru_cache(maxsize=8192)
 def norm_name(name: str) -> str:
-    n = (name or "").lower()
-    for rx in GENERIC_TOKENS:
-        n = re.sub(rx, "", n, flags=re.I)
-    n = re.sub(r"[^a-z0-9]+", " ", n)
+    n = _GENERIC_RE.sub("", (name or "").lower())
+    n = _NON_ALNUM_RE.sub(" ", n)
     return n.strip()
 
+# Ordem importa: a primeira categoria com alguma palavra-chave no nome vence.
+_CATEGORIAS = (
+    ("periféricos", ("mouse", "teclado", "headset")),
+    ("wearables", ("smartwatch", "pulseira")),
+    ("áudio", ("caixa de som", "bluetooth")),
+    ("projetor", ("projetor", "mini projetor", "hy300")),
+    ("cozinha", ("air fryer", "airfryer")),
+    ("segurança", ("câmera", "camera", "segurança")),
+    ("cama/banho", ("lençol", "jogo de cama")),
+    ("moda", ("bermuda", "calça", "blusa", "vestido", "touca", "gorro")),
+)
+
+@lru_cache(maxsize=8192)
 def tag_categoria(name: str) -> str:
     n = (name or "").lower()
-    if any(k in n for k in ["mouse", "teclado", "headset"]): return "periféricos"
-    if any(k in n for k in ["smartwatch", "pulseira"]): return "wearables"
-    if any(k in n for k in ["caixa de som", "bluetooth"]): return "áudio"
-    if any(k in n for k in ["projetor", "mini projetor", "hy300"]): return "projetor"
-    if any(k in n for k in ["air fryer", "airfryer"]): return "cozinha"
-    if any(k in n for k in ["câmera", "camera", "segurança"]): return "segurança"
-    if any(k in n for k in ["lençol", "jogo de cama"]): return "cama/banho"
-    if any(k in n for k in ["bermuda", "calça", "blusa", "vestido", "touca", "gorro"]): return "moda"
+    for cat, kws in _CATEGORIAS:
+        for k in kws:
+            if k in n:
+                return cat
     return "outros"
 
 def compact_name(name: str, max_len: int = 80) -> str:
-    n = (name or "").strip()
-    for rx in GENERIC_TOKENS:
-        n = re.sub(rx, "", n, flags=re.I)
-    n = re.sub(r"\s{2,}", " ", n).strip(" -–—·")
+    n = _GENERIC_RE.sub("", (name or "").strip())
+    n = _MULTISPACE_RE.sub(" ", n).strip(" -–—·")
     if len(n) > max_len:
         n = n[:max_len].rsplit(" ", 1)[0]
     return n
@@ -92,13 +111,13 @@ def remove_redundancy(text: str, product_name: str) -> str:
     t_low = t.lower()
     if base and t_low.startswith(base[: max(10, len(base)//2)]):
         t = t[len(base):].lstrip(" -—–:•")
-    t = re.sub(r"\s{2,}", " ", t).strip(" -—–•")
+    t = _MULTISPACE_RE.sub(" ", t).strip(" -—–•")
     return t
 
 def sanitize_copy(text: str) -> str:
     t = (text or "").strip()
-    t = re.sub(r"\b(aproveite|compre\s*agora|garanta\s*(o|a)\s*sua?)\b", "", t, flags=re.I)
-    t = re.sub(r"\s{2,}", " ", t).strip(" -—–•")
+    t = _CTA_COPY_RE.sub("", t)
+    t = _MULTISPACE_RE.sub(" ", t).strip(" -—–•")
     return t
 
 def load_keywords(path: str = "keywords.txt") -> List[str]:
@@ -126,61 +145,147 @@ def load_shop_ids() -> List[int]:
             out.append(int(tok))
     return out
 
-def is_good(prod: Dict[str, Any], *, min_rating: float, min_sales: int, min_discount: float) -> bool:
+def _num_float(v: Any) -> float:
     try:
-        rating = float(prod.get("ratingStar") or 0.0)
+        return float(v or 0.0)
     except Exception:
-        rating = 0.0
-    try:
-        sales = int(prod.get("sales") or 0)
-    except Exception:
-        sales = 0
+        return 0.0
+
+def _num_int(v: Any) -> int:
     try:
-        disc = float(prod.get("priceDiscountRate") or 0.0)
+        return int(v or 0)
     except Exception:
-        disc = 0.0
-    return (rating >= min_rating) and (sales >= min_sales) and (disc >= min_discount)
+        return 0
 
-def dedupe_signature(prod: Dict[str, Any]) -> str:
-    name = (prod.get("productName") or "").lower()
+def dedupe_signature(prod: Dict[str, Any]) -> int:
+    # hash (em C) da tupla canonizada: sem montar a string "nome__loja" por item; só vale dentro do processo
+    name = _NON_ALNUM_RE.sub(" ", (prod.get("productName") or "").lower())
     shop = (prod.get("shopName") or "").lower()
-    name_clean = re.sub(r"[^a-z0-9]+", " ", name)
-    return f"{name_clean.strip()}__{shop.strip()}"
+    return hash((name.strip(), shop.strip()))
+
+@dataclass
+class OfertasCols:
+    """Ofertas em colunas paralelas (struct-of-arrays): cada campo usado no filtro/ranking é
+    convertido uma única vez; `prods` guarda os dicts originais para a etapa de publicação."""
+    prods: List[Dict[str, Any]]
+    item_id: List[int]
+    rating: List[float]
+    sales: List[int]
+    discount: List[float]
+    sig: List[int]
+
+    def __len__(self) -> int:
+        return len(self.prods)
+
+    def take(self, idx: List[int]) -> "OfertasCols":
+        return OfertasCols(
+            prods=[self.prods[i] for i in idx],
+            item_id=[self.item_id[i] for i in idx],
+            rating=[self.rating[i] for i in idx],
+            sales=[self.sales[i] for i in idx],
+            discount=[self.discount[i] for i in idx],
+            sig=[self.sig[i] for i in idx],
+        )
+
+    def good(self, *, min_rating: float, min_sales: int, min_discount: float) -> "OfertasCols":
+        """Filtro de qualidade (rating/vendas/desconto mínimos) via scoring.quality_mask sobre as colunas."""
+        keep = quality_mask(self.rating, self.sales, self.discount,
+                            min_rating=min_rating, min_sales=min_sales, min_discount=min_discount)
+        return self.take([i for i, ok in enumerate(keep) if ok])
+
+    def unique(self) -> "OfertasCols":
+        """Primeira ocorrência de cada dedupe_signature."""
+        seen: set[int] = set()
+        idx: List[int] = []
+        for i, sig in enumerate(self.sig):
+            if sig not in seen:
+                seen.add(sig)
+                idx.append(i)
+        return self.take(idx)
+
+def to_cols(prods: List[Dict[str, Any]]) -> OfertasCols:
+    return OfertasCols(
+        prods=list(prods),
+        item_id=[_num_int(p.get("itemId")) for p in prods],
+        rating=[_num_float(p.get("ratingStar")) for p in prods],
+        sales=[_num_int(p.get("sales")) for p in prods],
+        discount=[_num_float(p.get("priceDiscountRate")) for p in prods],
+        sig=[dedupe_signature(p) for p in prods],
+    )
+
+# quantas buscas (fonte × página) vão num único POST GraphQL com aliases
+SEARCH_BATCH_SIZE = 10
+# lotes em voo ao mesmo tempo (limita a pressão no rate limit da API de afiliados)
+SEARCH_MAX_WORKERS = 4
+
+def _oferta_from_node(n: Dict[str, Any], fonte: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "itemId": n.get("itemId"),
+        "productName": (n.get("productName") or "").strip(),
+        "priceMin": n.get("priceMin"),
+        "priceMax": n.get("priceMax"),
+        "offerLink": n.get("offerLink"),
+        "productLink": n.get("productLink"),
+        "shopName": (n.get("shopName") or "").strip(),
+        "ratingStar": n.get("ratingStar"),
+        "sales": n.get("sales"),
+        "priceDiscountRate": n.get("priceDiscountRate"),
+        "keyword_origem": fonte["valor"] if fonte["tipo"] == "keyword" else None,
+    }
+
+def _buscar_lotes(client: ShopeeClient, buscas: List[Tuple[Dict[str, Any], int]]) -> List[Optional[OfferPage]]:
+    """Executa as buscas em lotes com aliases, até SEARCH_MAX_WORKERS lotes em paralelo."""
+    resultados: List[Optional[OfferPage]] = [None] * len(buscas)
+    lotes = [(start, buscas[start:start + SEARCH_BATCH_SIZE]) for start in range(0, len(buscas), SEARCH_BATCH_SIZE)]
+    if not lotes:
+        return resultados
+    with ThreadPoolExecutor(max_workers=max(1, min(SEARCH_MAX_WORKERS, len(lotes)))) as pool:
+        futures = {
+            pool.submit(client.product_offer_v2_batch,
+                        [(fonte["tipo"], fonte["valor"], p) for fonte, p in lote], limit=15): (start, len(lote))
+            for start, lote in lotes
+        }
+        for fut in as_completed(futures):
+            start, n = futures[fut]
+            try:
+                resultados[start:start + n] = fut.result()
+            except Exception as e:
+                logger.warning("Falha no lote de buscas %d-%d: %s", start + 1, start + n, e)
+    return resultados
 
 def coletar_ofertas(client: ShopeeClient, keywords: List[str], shop_ids: List[int], pages: int) -> List[Dict[str, Any]]:
-    ofertas: List[Dict[str, Any]] = []
     fontes: List[Dict[str, Any]] = ([{"tipo": "keyword", "valor": kw} for kw in keywords] +
                                     [{"tipo": "shopId", "valor": sid} for sid in shop_ids])
-    for fonte in fontes:
-        logger.info("Buscando %s='%s' ...", fonte["tipo"], fonte["valor"])
-        for p in range(1, pages + 1):
-            try:
-                if fonte["tipo"] == "keyword":
-                    nodes = client.product_offer_v2_by_keyword(str(fonte["valor"]), page=p, limit=15)
-                else:
-                    nodes = client.product_offer_v2_by_shop(int(fonte["valor"]), page=p, limit=15)
-            except Exception as e:
-                logger.warning("Falha na busca por %s '%s' (p%d): %s", fonte["tipo"], fonte["valor"], p, e)
-                break
-            for n in nodes:
-                ofertas.append({
-                    "itemId": n.get("itemId"),
-                    "productName": (n.get("productName") or "").strip(),
-                    "priceMin": n.get("priceMin"),
-                    "priceMax": n.get("priceMax"),
-                    "offerLink": n.get("offerLink"),
-                    "productLink": n.get("productLink"),
-                    "shopName": (n.get("shopName") or "").strip(),
-                    "ratingStar": n.get("ratingStar"),
-                    "sales": n.get("sales"),
-                    "priceDiscountRate": n.get("priceDiscountRate"),
-                    "keyword_origem": fonte["valor"] if fonte["tipo"] == "keyword" else None,
-                })
-            time.sleep(1.5)
-    uniq: Dict[str, Dict[str, Any]] = {}
-    for p in ofertas:
-        uniq[dedupe_signature(p)] = p
-    return list(uniq.values())
+    # página a página: a próxima só é pedida para fontes com pageInfo.hasNextPage (sem buscas vazias)
+    por_fonte: List[List[Dict[str, Any]]] = [[] for _ in fontes]
+    ativas = list(range(len(fontes)))
+    for p in range(1, pages + 1):
+        if not ativas:
+            break
+        logger.info("Buscando página %d de %d fonte(s) ...", p, len(ativas))
+        resultados = _buscar_lotes(client, [(fontes[i], p) for i in ativas])
+        proximas: List[int] = []
+        for i, page in zip(ativas, resultados):
+            fonte = fontes[i]
+            if page is None:
+                logger.warning("Falha na busca por %s '%s' (p%d)", fonte["tipo"], fonte["valor"], p)
+                continue
+            por_fonte[i].extend(_oferta_from_node(n, fonte) for n in page.nodes)
+            if page.has_next:
+                proximas.append(i)
+        ativas = proximas
+
+    # dedupe em uma passada: fica a primeira ocorrência (ordem fonte -> página)
+    seen: set[int] = set()
+    out: List[Dict[str, Any]] = []
+    for ofertas in por_fonte:
+        for o in ofertas:
+            sig = dedupe_signature(o)
+            if sig in seen:
+                continue
+            seen.add(sig)
+            out.append(o)
+    return out
 
 def heuristic_copies(prod: Dict[str, Any]) -> Dict[str, str]:
     n = (prod.get("productName") or "").lower()
@@ -226,6 +331,49 @@ def score_ia_or_fallback(batch: List[Dict[str, Any]]) -> IAResponse | Dict[str,
             })
         return {"items": items}
 
+# só o que define a copy (id, nome, hint) + o prompt; preço/rating/vendas mudam a cada execução
+# e não entram na copy, então ficariam de fora do cache quase sempre (a TTL limita a nota velha)
+_IA_KEY_FIELDS = ("itemId", "productName", "hint")
+_IA_PROMPT_TAG = hashlib.blake2b(SYSTEM_PROMPT.encode("utf-8"), digest_size=8).hexdigest()
+
+def ia_cache_key(prod: Dict[str, Any]) -> str:
+    raw = "\x1f".join([_IA_PROMPT_TAG] + ["" if prod.get(k) is None else str(prod.get(k)) for k in _IA_KEY_FIELDS])
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def ia_items(resp: IAResponse | Dict[str, Any]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """(itemId, {texto_de_venda_a, texto_de_venda_b, pontuacao}) da resposta da IA (IAResponse)
+    ou do fallback heurístico ({"items": [...]}); IAItem é lido por atributo, sem model_dump."""
+    if isinstance(resp, IAResponse):
+        for it in resp.analise_de_produtos:
+            yield it.itemId, {
+                "texto_de_venda_a": it.texto_de_venda_a,
+                "texto_de_venda_b": it.texto_de_venda_b,
+                "pontuacao": float(it.pontuacao or 0.0),
+            }
+        return
+    for it in resp.get("items", []):
+        try:
+            yield int(it["itemId"]), {
+                "texto_de_venda_a": it.get("texto_de_venda_a"),
+                "texto_de_venda_b": it.get("texto_de_venda_b"),
+                "pontuacao": float(it.get("pontuacao") or 0.0),
+            }
+        except Exception:
+            continue
+
+# lotes de IA em voo ao mesmo tempo (padrão de IA_WORKERS; ajuste ao RPM do Gemini)
+IA_MAX_WORKERS = 4
+
+def _absorve_ia(db: Storage, batch: List[Tuple[str, int, Dict[str, Any]]], resp: IAResponse | Dict[str, Any],
+                ia_by_id: Dict[int, Dict[str, Any]], max_age_s: float) -> None:
+    """Normaliza a resposta de um lote em ia_by_id e grava no cache (só resposta real do modelo)."""
+    ia_by_id.update(ia_items(resp))
+    if isinstance(resp, IAResponse) and not is_fallback(resp):
+        try:
+            db.ia_cache_put_many(((k, iid, ia_by_id[iid]) for k, iid, _ in batch if iid in ia_by_id), max_age_s=max_age_s)
+        except sqlite3.Error as e:
+            logger.warning("Falha ao gravar cache de IA: %s", e)
+
 def make_headline(product_name: str, benefit: str, *, emoji: Optional[str] = None, hint: Optional[str] = None, max_len: int = 110) -> str:
     base = compact_name(product_name, max_len=max_len)
     benefit = sanitize_copy(remove_redundancy(benefit, product_name))
@@ -233,7 +381,7 @@ def make_headline(product_name: str, benefit: str, *, emoji: Optional[str] = Non
         benefit = f"{benefit} — {hint}"
     em = (emoji or "✨").strip() or "✨"
     title = f"{em} {base} — {benefit}".strip()
-    title = re.sub(r"\s{2,}", " ", title).strip(" -–—•")
+    title = _MULTISPACE_RE.sub(" ", title).strip(" -–—•")
     if len(title) > max_len:
         title = title[:max_len].rsplit(" ", 1)[0]
     return title
@@ -246,37 +394,42 @@ def select_with_caps_and_dedupe(
 ) -> List[Tuple[float, Dict[str, Any], Dict[str, Any]]]:
     cap = max(1, int(max_posts * max_share)) if max_posts > 0 else 1
     selected: List[Tuple[float, Dict[str, Any], Dict[str, Any]]] = []
-    cat_counts: Dict[str, int] = {}
+    cat_counts: DefaultDict[str, int] = defaultdict(int)
     seen_norm: set[str] = set()
 
     rejections: List[Tuple[str, float, Dict[str, Any], Dict[str, Any]]] = []
     counters = {"cooldown": 0, "cap": 0, "dup": 0, "other": 0}
 
+    # último post de todos os candidatos numa só ida ao banco; o cooldown vira lookup em dict
+    last_posted = db.last_posted_map(int(prod.get("itemId") or 0) for _, _, prod in ranked)
+
     for final, ia_item, prod in ranked:
         if len(selected) >= max_posts:
             break
-        name = prod.get("productName") or ""
-        norm = norm_name(name)
-        cat = tag_categoria(name)
         item_id = int(prod.get("itemId") or 0)
         if not item_id:
             counters["other"] += 1
             continue
-        if not db.can_repost(item_id, cooldown_days=cooldown_days):
+        if not cooldown_ok(last_posted.get(item_id), cooldown_days):
             counters["cooldown"] += 1
             rejections.append(("cooldown", final, ia_item, prod))
             continue
+        # normalização/categoria só para quem passou nos checks baratos
+        name = prod.get("productName") or ""
+        norm = norm_name(name)
         if norm in seen_norm:
             counters["dup"] += 1
             rejections.append(("dup", final, ia_item, prod))
             continue
-        if cat_counts.get(cat, 0) >= cap:
+        cat = tag_categoria(name)
+        c = cat_counts[cat]
+        if c >= cap:
             counters["cap"] += 1
             rejections.append(("cap", final, ia_item, prod))
             continue
         selected.append((final, ia_item, prod))
         seen_norm.add(norm)
-        cat_counts[cat] = cat_counts.get(cat, 0) + 1
+        cat_counts[cat] = c + 1
 
     strict_sel = len(selected)
 
@@ -288,7 +441,7 @@ def select_with_caps_and_dedupe(
             if reason == "cooldown":
                 continue
             item_id = int(prod.get("itemId") or 0)
-            if not item_id or not db.can_repost(item_id, cooldown_days=cooldown_days):
+            if not item_id or not cooldown_ok(last_posted.get(item_id), cooldown_days):
                 continue
             norm = norm_name(prod.get("productName") or "")
             if norm in seen_norm:
@@ -307,8 +460,8 @@ def select_with_caps_and_dedupe(
             item_id = int(prod.get("itemId") or 0)
             if not item_id:
                 continue
-            last = db.last_posted_at(item_id) or 0.0
-            if db.can_repost(item_id, cooldown_days=relaxed_days):
+            last = last_posted.get(item_id) or 0.0
+            if cooldown_ok(last_posted.get(item_id), relaxed_days):
                 pool.append((last, final, ia_item, prod))
         pool.sort(key=lambda t: (0 if t[0] == 0 else 1, t[0]))
         used = 0
@@ -329,8 +482,63 @@ def select_with_caps_and_dedupe(
     )
     return selected
 
+_VARIANTS = ("A", "B")
+_CTA_BY_VARIANT = {"A": "Ver oferta", "B": "Abrir no app"}
+
 def pick_variant(rnd: random.Random) -> str:
-    return "A" if rnd.random() < 0.5 else "B"
+    # um bit do gerador basta para o A/B (sem random() em float + comparação)
+    return _VARIANTS[rnd.getrandbits(1)]
+
+def _prepare_post(p: Dict[str, Any], ia: Dict[str, Any], rnd: random.Random) -> Optional[Dict[str, Any]]:
+    """Monta título/variante/campos de um post; None se o item não tem id."""
+    iid = int(p.get("itemId") or 0)
+    if not iid:
+        return None
+    pname = str(p.get("productName") or "")
+    try:
+        price = float(p.get("priceMin") or 0.0)
+    except Exception:
+        price = None
+
+    text_a = (ia or {}).get("texto_de_venda_a") or heuristic_copies(p)["texto_de_venda_a"]
+    text_b = (ia or {}).get("texto_de_venda_b") or heuristic_copies(p)["texto_de_venda_b"]
+    variant = pick_variant(rnd)
+    benefit = text_a if variant == "A" else text_b
+
+    emoji_override = None
+    hint_kw = None
+    if kw_resolve_meta:
+        try:
+            cat_kw, emoji_kw, hints_kw = kw_resolve_meta(pname, p.get("keyword_origem"))
+            emoji_override = emoji_kw
+            hint_kw = hints_kw[0] if hints_kw else None
+        except Exception:
+            pass
+
+    return {
+        "iid": iid,
+        "variant": variant,
+        "title": make_headline(pname, benefit, emoji=emoji_override, hint=hint_kw),
+        "price": price,
+        "shop": (p.get("shopName") or "").strip(),
+        "rating": p.get("ratingStar"),
+        "sales": p.get("sales"),
+        "link": p.get("offerLink") or p.get("productLink") or "",
+    }
+
+def _send_post(pub: TelegramPublisher, post: Dict[str, Any]) -> bool:
+    rating, sales, price = post["rating"], post["sales"], post["price"]
+    return pub.send(
+        title=post["title"],
+        price_brl=price if price else None,
+        store=post["shop"] or None,
+        rating=float(rating) if rating not in (None, "") else None,
+        sales=int(sales) if str(sales).isdigit() else None,
+        link=post["link"],
+        cta=_CTA_BY_VARIANT[post["variant"]],
+        variant=post["variant"],
+        allow_preview=True,
+    )
 
 def publish_ranked_ab(
     pub: TelegramPublisher,
@@ -341,66 +549,35 @@ def publish_ranked_ab(
     rnd = random.Random(42 + int(time.time()) // 3600)
     posted = 0
 
-    for score, ia, p in ranked_selected:
-        if posted >= max_posts:
-            break
-        iid = int(p.get("itemId") or 0)
-        if not iid:
-            continue
-        pname = str(p.get("productName") or "")
-        shop = (p.get("shopName") or "").strip()
-        try:
-            price = float(p.get("priceMin") or 0.0)
-        except Exception:
-            price = None
-        rating = p.get("ratingStar")
-        sales = p.get("sales")
-        link = p.get("offerLink") or p.get("productLink") or ""
-
-        text_a = (ia or {}).get("texto_de_venda_a") or heuristic_copies(p)["texto_de_venda_a"]
-        text_b = (ia or {}).get("texto_de_venda_b") or heuristic_copies(p)["texto_de_venda_b"]
-        variant = pick_variant(rnd)
-        benefit = text_a if variant == "A" else text_b
-
-        emoji_override = None
-        hint_kw = None
-        if kw_resolve_meta:
-            try:
-                cat_kw, emoji_kw, hints_kw = kw_resolve_meta(pname, p.get("keyword_origem"))
-                emoji_override = emoji_kw
-                hint_kw = hints_kw[0] if hints_kw else None
-            except Exception:
-                pass
-
-        title = make_headline(pname, benefit, emoji=emoji_override, hint=hint_kw)
-
-        if dry_run:
-            logger.info("[DRY RUN] %s | %s | %s | %s", title, shop, f"R${price:.2f}" if price else "s/ preço", link)
-            posted += 1
-            db.record_post(iid, variant, message_id=None)
-            continue
+    try:
+        for _score, ia, p in ranked_selected:
+            if posted >= max_posts:
+                break
+            post = _prepare_post(p, ia, rnd)
+            if post is None:
+                continue
+            iid = post["iid"]
 
-        try:
-            ok = pub.send(
-                title=title,
-                price_brl=price if price else None,
-                store=shop or None,
-                rating=float(rating) if rating not in (None, "") else None,
-                sales=int(sales) if str(sales).isdigit() else None,
-                link=link,
-                cta=("Ver oferta" if variant == "A" else "Abrir no app"),
-                variant=variant,
-                allow_preview=True,
-            )
-            if ok:
+            if dry_run:
+                price = post["price"]
+                logger.info("[DRY RUN] %s | %s | %s | %s", post["title"], post["shop"],
+                            f"R${price:.2f}" if price else "s/ preço", post["link"])
                 posted += 1
-                db.record_post(iid, variant, message_id=getattr(pub, "last_message_id", None))
-        except requests.HTTPError as e:
-            logger.warning("Erro HTTP ao publicar item %s: %s", iid, e)
-        except re.error as e:
-            logger.warning("Erro de regex ao publicar item %s: %s", iid, e)
-        except Exception as e:
-            logger.warning("Erro ao publicar item %s: %s", iid, e)
+                db.queue_post(iid, post["variant"], message_id=None)
+                continue
+
+            try:
+                if _send_post(pub, post):
+                    posted += 1
+                    db.queue_post(iid, post["variant"], message_id=getattr(pub, "last_message_id", None))
+            except requests.HTTPError as e:
+                logger.warning("Erro HTTP ao publicar item %s: %s", iid, e)
+            except re.error as e:
+                logger.warning("Erro de regex ao publicar item %s: %s", iid, e)
+            except Exception as e:
+                logger.warning("Erro ao publicar item %s: %s", iid, e)
+    finally:
+        db.flush_posts()  # grava o lote pendente mesmo se algo estourar no meio
 
     return posted
 
@@ -419,6 +596,9 @@ def main() -> int:
     MIN_SALES = getenv_int("MIN_SALES_DEFAULT", 100)
     MAX_CATEGORY_SHARE = float(os.getenv("MAX_CATEGORY_SHARE", "0.5"))
     COOLDOWN_DIAS = getenv_int("COOLDOWN_REPOSTAGEM_DIAS", 5)
+    IA_CACHE_TTL_HORAS = getenv_float("IA_CACHE_TTL_HORAS", 24.0)
+    IA_BATCH_SIZE = max(1, getenv_int("IA_BATCH_SIZE", 10))
+    IA_WORKERS = max(1, getenv_int("IA_WORKERS", IA_MAX_WORKERS))
 
     ALLOW_NO_CAP_ON_SHORTFALL = getenv_bool("ALLOW_NO_CAP_ON_SHORTFALL", True)
     EMERGENCY_FILL_ENABLED = getenv_bool("EMERGENCY_FILL_ENABLED", True)
@@ -427,65 +607,61 @@ def main() -> int:
 
     keywords = load_keywords("keywords.txt")
     shops = load_shop_ids()
+    ai_preload()
 
     logger.info("Coletando ofertas (GraphQL Affiliate)...")
     client = ShopeeClient(partner_id, api_key)
     ofertas = coletar_ofertas(client, keywords, shops, PAGES)
     logger.info("Coleta bruta: %d ofertas", len(ofertas))
 
-    cand = [p for p in ofertas if is_good(p, min_rating=MIN_RATING, min_sales=MIN_SALES, min_discount=MIN_DISCOUNT)]
-    logger.info("Candidatos após filtros de qualidade: %d", len(cand))
+    cols = to_cols(ofertas).good(min_rating=MIN_RATING, min_sales=MIN_SALES, min_discount=MIN_DISCOUNT)
+    logger.info("Candidatos após filtros de qualidade: %d", len(cols))
 
-    seen_sig = set()
-    deduped = []
-    for p in cand:
-        sig = dedupe_signature(p)
-        if sig in seen_sig:
-            continue
-        seen_sig.add(sig)
-        deduped.append(p)
+    cols = cols.unique()
+    deduped = cols.prods
     logger.info("Após dedupe por assinatura: %d", len(deduped))
 
     if not deduped:
         logger.info("Sem candidatos após filtros. Nada a publicar.")
         return 0
 
-    BATCH = 10
-    ia_by_id: Dict[int, Dict[str, Any]] = {}
-    for i in range(0, len(deduped), BATCH):
-        batch = deduped[i: i + BATCH]
-        resp = score_ia_or_fallback(batch)
-        items = getattr(resp, "items", None) or resp.get("items", [])
-        for it in items:
-            try:
-                ia_by_id[int(it["itemId"])] = {
-                    "texto_de_venda_a": it.get("texto_de_venda_a"),
-                    "texto_de_venda_b": it.get("texto_de_venda_b"),
-                    "pontuacao": float(it.get("pontuacao") or 0.0),
-                }
-            except Exception:
-                continue
+    db = Storage(DB_PATH)
 
-    ranked: List[Tuple[float, Dict[str, Any], Dict[str, Any]]] = []
-    for p in deduped:
-        iid = int(p.get("itemId") or 0)
+    # IA: reaproveita respostas persistidas de produtos sem mudança; só o resto vai ao modelo
+    ia_by_id: Dict[int, Dict[str, Any]] = {}
+    keys = [ia_cache_key(p) for p in deduped]
+    hits = db.ia_cache_get_many(keys, max_age_s=IA_CACHE_TTL_HORAS * 3600)
+    misses: List[Tuple[str, int, Dict[str, Any]]] = []
+    for k, iid, p in zip(keys, cols.item_id, deduped):
+        if k in hits:
+            ia_by_id[iid] = hits[k]
+        else:
+            misses.append((k, iid, p))
+    logger.info("IA: %d do cache, %d a consultar", len(deduped) - len(misses), len(misses))
+    lotes = [misses[i: i + IA_BATCH_SIZE] for i in range(0, len(misses), IA_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=max(1, min(IA_WORKERS, len(lotes)))) as pool:
+        # map devolve na ordem dos lotes; cache/SQLite seguem na thread principal
+        resps = pool.map(score_ia_or_fallback, [[p for _, _, p in b] for b in lotes])
+        for batch, resp in zip(lotes, resps):
+            _absorve_ia(db, batch, resp, ia_by_id, IA_CACHE_TTL_HORAS * 3600)
+
+    ias: List[Dict[str, Any]] = []
+    ia_scores: List[float] = []
+    for iid, p in zip(cols.item_id, deduped):
         ia = ia_by_id.get(iid) or heuristic_copies(p)
-        ia_score = (ia.get("pontuacao") or 70.0)
-        try:
-            disc = float(p.get("priceDiscountRate") or 0.0)
-        except Exception:
-            disc = 0.0
-        disc_n = max(0.0, min(1.0, disc))
-        try:
-            ev = compute_ev_signal(p.get("shopName") or "", p.get("productName") or "")
-        except Exception:
-            ev = 0.0
-        final = 0.45 * (ia_score / 100.0) + 0.25 * disc_n + 0.30 * ev
-        ranked.append((final, ia, p))
-    ranked.sort(key=lambda x: x[0], reverse=True)
+        ias.append(ia)
+        ia_scores.append(ia.get("pontuacao") or 70.0)
+    # EV de todos os candidatos numa leitura só das tabelas ev_*_agg
+    try:
+        evs = compute_ev_signals_bulk(DB_PATH, ((iid, p.get("shopName")) for iid, p in zip(cols.item_id, deduped)))
+    except Exception as e:
+        logger.warning("EV indisponível (sem dados de conversões?): %s", e)
+        evs = [0.0] * len(deduped)
+    ranked: List[Tuple[float, Dict[str, Any], Dict[str, Any]]] = [
+        (final, ias[k], deduped[k]) for k, final in rank_desc(ia_scores, cols.discount, evs)
+    ]
 
-    db = Storage(DB_PATH)
-    pub = TelegramPublisher(token=telegram_token, chat_id=telegram_chat)
+    pub = TelegramPublisher(bot_token=telegram_token, chat_id=telegram_chat)
 
     selected = select_with_caps_and_dedupe(
         ranked,
@@ -522,6 +698,12 @@ def main() -> int:
             logger.warning("Resgate falhou: %s", e)
 
     logger.info("Publicações concluídas: %d", posted)
+    try:
+        db.optimize()
+    except Exception as e:
+        logger.warning("PRAGMA optimize falhou: %s", e)
+    finally:
+        db.close()
     return posted
 
 if __name__ == "__main__":
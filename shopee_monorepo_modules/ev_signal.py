@@ -1,67 +1,210 @@
 # shopee_monorepo_modules/ev_signal.py
 from __future__ import annotations
-import sqlite3, time, math
-from typing import Optional
+import sqlite3, time, math, threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from shopee_monorepo_modules.sqlite_tuning import apply_pragmas
+try:
+    import numpy as np  # opcional: mistura de EV vetorizada no modo em lote
+except ImportError:  # pragma: no cover
+    np = None
+
+# janela usada por conversions_sync.rebuild_ev_tables ao materializar ev_*_agg
+EV_WINDOW_DAYS = 28
+
+# coluna de conversion_items -> tabela materializada com SUM(item_total_commission) por chave
+_AGG_TABLES = {
+    "item_id": "ev_item_agg",
+    "shop_name": "ev_shop_agg",
+    "globalCategoryLv1Name": "ev_cat_agg",
+}
 
 def _sigmoid_like(x: float, k: float = 30.0) -> float:
     if x <= 0: return 0.0
     return 1.0 - math.exp(-x / max(1e-9, k))
 
-def compute_ev_signal(db_path: str, *, item_id: int, product_name: str, shop_name: Optional[str], window_days: int = 28) -> float:
-    cutoff = int(time.time()) - window_days * 86400
-    cat = None
-    item_ev = 0.0
-    shop_ev = 0.0
-    cat_ev = 0.0
-    with sqlite3.connect(db_path) as con:
-        cur = con.cursor()
-        cur.execute("""
-            SELECT COALESCE(SUM(ci.item_total_commission),0.0)
-            FROM conversion_items ci
-            JOIN conversions c ON c.conversion_id = ci.conversion_id
-            WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
-              AND ci.item_id = ?
-        """, (cutoff, item_id))
-        row = cur.fetchone()
-        if row and row[0] is not None:
-            try: item_ev = float(row[0])
-            except: item_ev = 0.0
-        if shop_name:
-            cur.execute("""
-                SELECT COALESCE(SUM(ci.item_total_commission),0.0)
-                FROM conversion_items ci
-                JOIN conversions c ON c.conversion_id = ci.conversion_id
-                WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
-                  AND ci.shop_name = ?
-            """, (cutoff, shop_name))
-            r2 = cur.fetchone()
-            if r2 and r2[0] is not None:
-                try: shop_ev = float(r2[0])
-                except: shop_ev = 0.0
-        cur.execute("""
-            SELECT globalCategoryLv1Name, COUNT(*) AS n
-            FROM conversion_items
-            WHERE item_id = ?
-            GROUP BY globalCategoryLv1Name
-            ORDER BY n DESC LIMIT 1
-        """, (item_id,))
-        r3 = cur.fetchone()
-        if r3 and r3[0]:
-            cat = r3[0]
-        if cat:
-            cur.execute("""
-                SELECT COALESCE(SUM(ci.item_total_commission),0.0)
-                FROM conversion_items ci
-                JOIN conversions c ON c.conversion_id = ci.conversion_id
-                WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
-                  AND ci.globalCategoryLv1Name = ?
-            """, (cutoff, cat))
-            r4 = cur.fetchone()
-            if r4 and r4[0] is not None:
-                try: cat_ev = float(r4[0])
-                except: cat_ev = 0.0
-
+def _blend(item_ev: float, shop_ev: float, cat_ev: float) -> float:
     s_item = _sigmoid_like(item_ev, 30.0)
     s_shop = _sigmoid_like(shop_ev, 80.0)
     s_cat  = _sigmoid_like(cat_ev, 150.0)
     return 0.6 * s_item + 0.3 * s_shop + 0.1 * s_cat
+
+def _ev_blend_np(item, shop, cat):
+    """Mesmo cálculo de _blend sobre arrays float64 (x <= 0 vira 0, como em _sigmoid_like)."""
+    return (0.6 * (1.0 - np.exp(-np.maximum(item, 0.0) / 30.0))
+            + 0.3 * (1.0 - np.exp(-np.maximum(shop, 0.0) / 80.0))
+            + 0.1 * (1.0 - np.exp(-np.maximum(cat, 0.0) / 150.0)))
+
+def _as_float(v) -> float:
+    if v is None: return 0.0
+    try: return float(v)
+    except: return 0.0
+
+def _has_agg_tables(cur: sqlite3.Cursor) -> bool:
+    names = tuple(_AGG_TABLES.values())
+    cur.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ({','.join('?' * len(names))})",
+        names,
+    )
+    return cur.fetchone()[0] == len(names)
+
+def _agg_sum(cur: sqlite3.Cursor, column: str, value) -> float:
+    """Leitura O(1) da soma já materializada (B-tree na chave)."""
+    cur.execute(f"SELECT ev_sum FROM {_AGG_TABLES[column]} WHERE key = ?", (value,))
+    row = cur.fetchone()
+    return _as_float(row[0]) if row else 0.0
+
+def _live_sum(cur: sqlite3.Cursor, column: str, value, cutoff: int) -> float:
+    """Agrega direto em conversion_items (janela diferente da materializada ou tabelas ausentes)."""
+    if column not in _AGG_TABLES:
+        raise ValueError(f"Coluna inválida: {column}")
+    cur.execute(f"""
+        SELECT COALESCE(SUM(ci.item_total_commission),0.0)
+        FROM conversion_items ci
+        JOIN conversions c ON c.conversion_id = ci.conversion_id
+        WHERE (c.purchase_time IS NULL OR c.purchase_time >= ?)
+          AND ci.{column} = ?
+    """, (cutoff, value))
+    row = cur.fetchone()
+    return _as_float(row[0]) if row else 0.0
+
+def _top_category(cur: sqlite3.Cursor, item_id: int) -> Optional[str]:
+    try:
+        cur.execute("SELECT cat FROM ev_item_cat WHERE item_id = ?", (item_id,))
+        r = cur.fetchone()
+        return r[0] if r and r[0] else None
+    except sqlite3.OperationalError:
+        pass  # ev_item_cat ainda não materializada: agrega na hora
+    cur.execute("""
+        SELECT globalCategoryLv1Name, COUNT(*) AS n
+        FROM conversion_items
+        WHERE item_id = ?
+        GROUP BY globalCategoryLv1Name
+        ORDER BY n DESC, globalCategoryLv1Name LIMIT 1
+    """, (item_id,))
+    r = cur.fetchone()
+    return r[0] if r and r[0] else None
+
+class EVSignalCache:
+    """Conexão persistente para calcular EV produto a produto.
+    Reaproveita a conexão (e o cache de statements preparados do sqlite3, já que o SQL é
+    sempre o mesmo texto) e, depois de encontrar as tabelas ev_*_agg, não consulta mais o sqlite_master."""
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.con = sqlite3.connect(db_path, check_same_thread=False, cached_statements=64)
+        apply_pragmas(self.con)
+        self._lock = threading.Lock()
+        self._has_agg = False  # só memoriza True: as tabelas podem surgir depois (rebuild)
+
+    def signal(self, *, item_id: int, shop_name: Optional[str], window_days: int = EV_WINDOW_DAYS) -> float:
+        cutoff = int(time.time()) - window_days * 86400
+        item_ev = 0.0
+        shop_ev = 0.0
+        cat_ev = 0.0
+        with self._lock:
+            cur = self.con.cursor()
+            cat = _top_category(cur, item_id)
+            if window_days == EV_WINDOW_DAYS and not self._has_agg:
+                self._has_agg = _has_agg_tables(cur)
+            if window_days == EV_WINDOW_DAYS and self._has_agg:
+                item_ev = _agg_sum(cur, "item_id", item_id)
+                if shop_name:
+                    shop_ev = _agg_sum(cur, "shop_name", shop_name)
+                if cat:
+                    cat_ev = _agg_sum(cur, "globalCategoryLv1Name", cat)
+            else:
+                item_ev = _live_sum(cur, "item_id", item_id, cutoff)
+                if shop_name:
+                    shop_ev = _live_sum(cur, "shop_name", shop_name, cutoff)
+                if cat:
+                    cat_ev = _live_sum(cur, "globalCategoryLv1Name", cat, cutoff)
+        return _blend(item_ev, shop_ev, cat_ev)
+
+    def close(self) -> None:
+        with self._lock:
+            self.con.close()
+
+_EV_CACHES: Dict[str, EVSignalCache] = {}
+_EV_CACHES_LOCK = threading.Lock()
+
+def _get_ev_cache(db_path: str) -> EVSignalCache:
+    with _EV_CACHES_LOCK:
+        cache = _EV_CACHES.get(db_path)
+        if cache is None:
+            cache = _EV_CACHES[db_path] = EVSignalCache(db_path)
+        return cache
+
+def compute_ev_signal(db_path: str, *, item_id: int, product_name: str, shop_name: Optional[str], window_days: int = 28) -> float:
+    return _get_ev_cache(db_path).signal(item_id=item_id, shop_name=shop_name, window_days=window_days)
+
+def _in_chunks(keys: List, chunk: int = 500):
+    for k in range(0, len(keys), chunk):
+        part = keys[k:k + chunk]
+        yield part, ",".join("?" * len(part))
+
+def _load_agg(cur: sqlite3.Cursor, table: str, keys: Iterable) -> Dict:
+    """ev_sum só das chaves pedidas (IN em blocos), não a tabela inteira."""
+    keys = list(dict.fromkeys(k for k in keys if k))
+    out: Dict = {}
+    for part, qs in _in_chunks(keys):
+        cur.execute(f"SELECT key, ev_sum FROM {table} WHERE key IN ({qs})", part)
+        out.update((k, _as_float(v)) for k, v in cur.fetchall())
+    return out
+
+def _load_top_categories(cur: sqlite3.Cursor, item_ids: Iterable[int]) -> Dict[int, Optional[str]]:
+    """Categoria mais frequente de cada item pedido (mesmo desempate de _top_category)."""
+    ids = list(dict.fromkeys(i for i in item_ids if i))
+    top: Dict[int, Optional[str]] = {}
+    try:
+        for part, qs in _in_chunks(ids):
+            cur.execute(f"SELECT item_id, cat FROM ev_item_cat WHERE item_id IN ({qs})", part)
+            top.update((iid, cat or None) for iid, cat in cur.fetchall())
+        return top
+    except sqlite3.OperationalError:
+        top.clear()
+    for part, qs in _in_chunks(ids):
+        cur.execute(f"""
+            SELECT item_id, globalCategoryLv1Name, COUNT(*) AS n
+            FROM conversion_items
+            WHERE item_id IN ({qs})
+            GROUP BY item_id, globalCategoryLv1Name
+            ORDER BY item_id, n DESC, globalCategoryLv1Name
+        """, part)
+        for iid, cat, _n in cur.fetchall():
+            if iid not in top:
+                top[iid] = cat or None
+    return top
+
+def compute_ev_signals_bulk(db_path: str, items: Iterable[Tuple[int, Optional[str]]]) -> List[float]:
+    """EV de vários produtos (item_id, shop_name), na mesma ordem, com uma consulta IN por tabela
+    ev_*_agg. Sem as tabelas materializadas, cai no cálculo item a item de compute_ev_signal."""
+    items = list(items)
+    if not items:
+        return []
+    with sqlite3.connect(db_path) as con:
+        apply_pragmas(con)
+        cur = con.cursor()
+        if _has_agg_tables(cur):
+            top_cat = _load_top_categories(cur, (iid for iid, _ in items))
+            item_sums = _load_agg(cur, "ev_item_agg", (iid for iid, _ in items))
+            shop_sums = _load_agg(cur, "ev_shop_agg", (shop for _, shop in items))
+            cat_sums = _load_agg(cur, "ev_cat_agg", top_cat.values())
+        else:
+            top_cat = None
+    if top_cat is None:
+        cache = _get_ev_cache(db_path)
+        return [cache.signal(item_id=iid, shop_name=shop) for iid, shop in items]
+    item_ev: List[float] = []
+    shop_ev: List[float] = []
+    cat_ev: List[float] = []
+    for item_id, shop_name in items:
+        cat = top_cat.get(item_id)
+        item_ev.append(item_sums.get(item_id, 0.0))
+        shop_ev.append(shop_sums.get(shop_name, 0.0) if shop_name else 0.0)
+        cat_ev.append(cat_sums.get(cat, 0.0) if cat else 0.0)
+    if np is None:
+        return [_blend(i, s, c) for i, s, c in zip(item_ev, shop_ev, cat_ev)]
+    return _ev_blend_np(
+        np.asarray(item_ev, dtype=np.float64),
+        np.asarray(shop_ev, dtype=np.float64),
+        np.asarray(cat_ev, dtype=np.float64),
+    ).tolist()
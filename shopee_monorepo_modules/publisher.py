@@ -1,31 +1,114 @@
 # publisher.py — envio robusto ao Telegram (HTML seguro + fallbacks)
 from __future__ import annotations
-import requests, html, time, logging
+import requests, time, logging, threading, math
+from functools import lru_cache
+from requests.adapters import HTTPAdapter, Retry
 from typing import Optional, Dict, Any
 
 log = logging.getLogger("publisher")
 
+# mesmo resultado de html.escape(quote=True), mas numa única passada (translate) em vez de 5 replace
+_HTML_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
 def _escape_html_text(s: str) -> str:
     # escapa texto; não use para URLs
-    return html.escape(s, quote=True)
+    return s.translate(_HTML_TABLE) if s else ""
+
+# loja e CTA se repetem entre posts (e entre variantes A/B): escapa cada valor uma vez só
+_escape_repeated = lru_cache(maxsize=256)(_escape_html_text)
 
 def _safe_url(url: str) -> str:
     # Telegram aceita & sem precisar virar &amp; no atributo href
     return url.strip()
 
+@lru_cache(maxsize=4096)
+def _fmt_currency_br(v: float) -> str:
+    """1234.5 -> 'R$ 1.234,50' (uma formatação + agrupamento por fatias, sem 3x replace)."""
+    if not math.isfinite(v):
+        return f"R$ {v:.2f}"  # nan/inf: mesma saída de antes ("R$ nan"), sem derrubar a mensagem
+    s = f"{v:.2f}"
+    sign = "-" if s[0] == "-" else ""
+    ints, frac = s.lstrip("-").split(".")
+    head = len(ints) % 3 or 3
+    groups = [ints[:head]] + [ints[i:i + 3] for i in range(head, len(ints), 3)]
+    return f"R$ {sign}{'.'.join(groups)},{frac}"
+
+def _make_session() -> requests.Session:
+    # keep-alive (uma conexão TLS reaproveitada entre envios). sendMessage não é idempotente:
+    # só repete quando a mensagem com certeza não foi aceita (falha de conexão ou 429 com Retry-After);
+    # timeout de leitura e 5xx ficam com quem chama (o Telegram pode já ter publicado).
+    # raise_on_status=False devolve a última resposta para o raise_for_status/fallbacks de send()
+    s = requests.Session()
+    retries = Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=3,
+        other=0,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    return s
+
+def _is_bad_request(e: requests.HTTPError) -> bool:
+    # só 400 (entidades/parse do HTML, texto grande demais) justifica reenviar em outro formato
+    return e.response is not None and e.response.status_code == 400
+
+class TokenBucket:
+    """Limitador de taxa (token bucket via "próximo horário livre", relógio monotônico).
+    rate = envios por segundo; burst = quantos podem sair seguidos antes de esperar.
+    O lock só protege a conta (nunca é segurado durante o sleep)."""
+    def __init__(self, rate: float = 1.0, burst: int = 1):
+        self.interval = 1.0 / max(1e-9, float(rate))
+        self.burst = max(1, int(burst))
+        self._tat = time.monotonic()  # "theoretical arrival time" do próximo token
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            wait = tat - (self.burst - 1) * self.interval - now
+            self._tat = tat + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def penalize(self, seconds: float) -> None:
+        """Pausa o bucket (ex.: retry_after de um 429): nenhum token antes de agora + seconds."""
+        with self._lock:
+            self._tat = max(self._tat, time.monotonic() + max(0.0, float(seconds)) + (self.burst - 1) * self.interval)
+
+# Telegram: ~1 msg/s por chat (rajadas curtas toleradas)
+TELEGRAM_CHAT_RATE = 1.0
+TELEGRAM_CHAT_BURST = 3
+
 class TelegramPublisher:
-    def __init__(self, bot_token: str, chat_id: str, timeout: int = 15):
+    def __init__(self, bot_token: str, chat_id: str, timeout: int = 15, session: Optional[requests.Session] = None,
+                 bucket: Optional[TokenBucket] = None):
         self.base = f"https://api.telegram.org/bot{bot_token}"
+        self._send_url = f"{self.base}/sendMessage"
         self.chat_id = chat_id
         self.timeout = timeout
+        self.session = session or _make_session()
+        self.bucket = bucket or TokenBucket(rate=TELEGRAM_CHAT_RATE, burst=TELEGRAM_CHAT_BURST)
 
     def _send(self, payload: Dict[str, Any]) -> Dict[str, Any]:
-        url = f"{self.base}/sendMessage"
-        r = requests.post(url, json=payload, timeout=self.timeout)
+        self.bucket.acquire()
+        r = self.session.post(self._send_url, json=payload, timeout=self.timeout)
         try:
             j = r.json()
         except Exception:
             j = {}
+        if r.status_code in (420, 429):
+            retry_after = (j.get("parameters") or {}).get("retry_after") or r.headers.get("Retry-After") or 1
+            try:
+                self.bucket.penalize(float(retry_after))
+            except (TypeError, ValueError):
+                self.bucket.penalize(1.0)
         if r.status_code != 200:
             desc = j.get("description") or r.text
             log.error("Telegram erro %s: %s", r.status_code, desc)
@@ -37,9 +120,9 @@ class TelegramPublisher:
         """Tenta enviar com HTML; se der 400, reenviar sem parse_mode e/ou dividido."""
         # Monta mensagem
         t = _escape_html_text(title)
-        s = _escape_html_text(store)
-        cta_txt = _escape_html_text(cta)
-        price = f"R$ {price_brl:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        s = _escape_repeated(store)
+        cta_txt = _escape_repeated(cta)
+        price = _fmt_currency_br(price_brl)
         meta = []
         if rating is not None:
             meta.append(f"⭐️ {rating:.1f}+")
@@ -60,6 +143,10 @@ class TelegramPublisher:
             self._send(payload)
             return True
         except requests.HTTPError as e:
+            if not _is_bad_request(e):
+                # 429/5xx: a mensagem pode ter sido aceita; reenviar em outro formato duplicaria o post
+                log.error("Envio falhou (sem fallback): %s", str(e))
+                return False
             # Fallback 1: enviar sem parse_mode (texto puro com link em linha separada)
             log.warning("HTML falhou, tentando texto puro. Motivo: %s", str(e))
             plain = f"{title}\n\nPreço: {price}\nLoja: {store}\n{meta_line}\n\n{cta}:\n{url}\n"
@@ -73,6 +160,8 @@ class TelegramPublisher:
                 return True
             except requests.HTTPError as e2:
                 log.error("Falha também no texto puro: %s", str(e2))
+                if not _is_bad_request(e2):
+                    return False
                 # Fallback 2: mensagem mínima (reduzir risco de parse/limites)
                 minimal = f"{title} — {price}\n{url}"
                 payload3 = {"chat_id": self.chat_id, "text": minimal[:3800], "disable_web_page_preview": True}
@@ -7,15 +7,24 @@ import hmac
 import hashlib
 import logging
 import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
+try:
+    from urllib3.util.request import ACCEPT_ENCODING  # "gzip,deflate" (+ ",br"/",zstd" se os decoders existirem)
+except ImportError:  # pragma: no cover
+    ACCEPT_ENCODING = "gzip,deflate"
+try:
+    import orjson  # opcional: serialização/parse em C
+except ImportError:  # pragma: no cover
+    orjson = None
 
 LOGGER = logging.getLogger("shopee_client")
 
 GRAPHQL_URL = "https://open-api.affiliate.shopee.com.br/graphql"
 GRAPHQL_PATH = "/graphql"
+_GRAPHQL_PATH_B = GRAPHQL_PATH.encode("ascii")
 UA = "Mozilla/5.0 (compatible; ShopeeAffiliateBot/2.0; +github-actions)"
 
 def _make_session() -> requests.Session:
@@ -27,12 +36,39 @@ def _make_session() -> requests.Session:
         allowed_methods=["GET", "POST", "HEAD"],
         respect_retry_after_header=True,
     )
-    s.mount("https://", HTTPAdapter(max_retries=retries))
-    s.headers.update({"User-Agent": UA})
+    # pool maior para as buscas em lote paralelas (coletar_ofertas) reaproveitarem conexões TLS
+    s.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retries))
+    s.headers.update({"User-Agent": UA, "Accept-Encoding": ACCEPT_ENCODING})
     return s
 
-def _hmac_sha256_hex(secret: str, message: str) -> str:
-    return hmac.new(secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).hexdigest()
+def _dumps(obj: Any) -> bytes:
+    """JSON compacto; é exatamente o corpo enviado e o que entra na assinatura."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def _loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+_NODE_FIELDS = (
+    "itemId productName priceMin priceMax offerLink productLink "
+    "shopName ratingStar sales priceDiscountRate"
+)
+
+class OfferPage(NamedTuple):
+    nodes: List[Dict[str, Any]]
+    has_next: bool  # pageInfo.hasNextPage (sem pageInfo: página cheia => provavelmente há mais)
+
+def _offer_args(kind: str, value: Any, page: int, limit: int) -> str:
+    """Argumentos de productOfferV2 para uma busca por keyword ou por shopId."""
+    if kind == "keyword":
+        kw = str(value).replace('"', '\\"')
+        return f'keyword: "{kw}", limit: {int(limit)}, page: {int(page)}'
+    if kind == "shopId":
+        return f"shopId: {int(value)}, limit: {int(limit)}, page: {int(page)}"
+    raise ValueError(f"Tipo de busca inválido: {kind}")
 
 class ShopeeClient:
     """
@@ -50,6 +86,8 @@ class ShopeeClient:
         self.api_key = api_key.strip()
         self.session = session or _make_session()
         self.last_auth_mode: Optional[str] = None
+        # HMAC já alimentado com o prefixo fixo (partner_id); cada assinatura parte de um .copy()
+        self._hmac_prefix = hmac.new(self.api_key.encode("utf-8"), self.partner_id.encode("utf-8"), hashlib.sha256)
 
         forced = os.getenv("SHOPEE_AUTH_MODE", "").strip()
         self.forced_mode = forced if forced in ("v2_payload", "v3_path", "v1_min") else None
@@ -57,21 +95,20 @@ class ShopeeClient:
             LOGGER.info("Forçando modo de assinatura: %s", self.forced_mode)
 
     # ---- Assinaturas (HMAC) -------------------------------------------------
-    def _auth_header(self, payload: Dict[str, Any], mode: str, ts: int) -> str:
-        payload_str = json.dumps(payload, separators=(",", ":"))
-        if mode == "v2_payload":
-            base = f"{self.partner_id}{ts}{payload_str}"
-        elif mode == "v3_path":
-            base = f"{self.partner_id}{ts}{GRAPHQL_PATH}{payload_str}"
-        elif mode == "v1_min":
-            base = f"{self.partner_id}{ts}"
-        else:
+    def _auth_header(self, payload: bytes, mode: str, ts: int) -> str:
+        if mode not in ("v2_payload", "v3_path", "v1_min"):
             raise ValueError(f"Modo de assinatura inválido: {mode}")
-        sign = _hmac_sha256_hex(self.api_key, base)
-        return f"SHA256 Credential={self.partner_id}, Timestamp={ts}, Signature={sign}"
+        h = self._hmac_prefix.copy()
+        h.update(str(ts).encode("ascii"))
+        if mode == "v3_path":
+            h.update(_GRAPHQL_PATH_B)
+        if mode != "v1_min":
+            h.update(payload)
+        return f"SHA256 Credential={self.partner_id}, Timestamp={ts}, Signature={h.hexdigest()}"
 
     def _post_graphql_auto(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        body = {"query": query, "variables": variables or {}}
+        # serializa uma vez: o mesmo texto é assinado e enviado (independe do modo/tentativa)
+        raw = _dumps({"query": query, "variables": variables or {}})
         modes = ["v2_payload", "v3_path", "v1_min"]
 
         # Força um modo? Coloca ele primeiro e ignora o resto na falha de 401/403/Invalid Signature
@@ -85,13 +122,13 @@ class ShopeeClient:
         for mode in modes:
             ts = int(time.time())  # segundos
             headers = {
-                "Authorization": self._auth_header(body, mode, ts),
+                "Authorization": self._auth_header(raw, mode, ts),
                 "Content-Type": "application/json",
             }
             try:
-                resp = self.session.post(GRAPHQL_URL, json=body, headers=headers, timeout=20)
+                resp = self.session.post(GRAPHQL_URL, data=raw, headers=headers, timeout=20)
                 resp.raise_for_status()
-                data = resp.json()
+                data = _loads(resp.content)
             except requests.HTTPError as e:
                 # 401/403 geralmente é assinatura -> tenta próximo modo
                 code = e.response.status_code if e.response is not None else None
@@ -117,13 +154,10 @@ class ShopeeClient:
 
     # ---- Consultas de produtos ---------------------------------------------
     def product_offer_v2_by_keyword(self, keyword: str, *, page: int = 1, limit: int = 15) -> List[Dict[str, Any]]:
-        kw = keyword.replace('"', '\\"')
         query = (
             "query { productOfferV2("
-            f'keyword: "{kw}", limit: {int(limit)}, page: {int(page)}'
-            ") { nodes { "
-            "itemId productName priceMin priceMax offerLink productLink "
-            "shopName ratingStar sales priceDiscountRate } } }"
+            + _offer_args("keyword", keyword, page, limit)
+            + f") {{ nodes {{ {_NODE_FIELDS} }} }} }}"
         )
         data = self._post_graphql_auto(query)
         return (data.get("data", {})
@@ -133,12 +167,40 @@ class ShopeeClient:
     def product_offer_v2_by_shop(self, shop_id: int, *, page: int = 1, limit: int = 15) -> List[Dict[str, Any]]:
         query = (
             "query { productOfferV2("
-            f"shopId: {int(shop_id)}, limit: {int(limit)}, page: {int(page)}"
-            ") { nodes { "
-            "itemId productName priceMin priceMax offerLink productLink "
-            "shopName ratingStar sales priceDiscountRate } } }"
+            + _offer_args("shopId", shop_id, page, limit)
+            + f") {{ nodes {{ {_NODE_FIELDS} }} }} }}"
         )
         data = self._post_graphql_auto(query)
         return (data.get("data", {})
                     .get("productOfferV2", {})
                     .get("nodes", [])) or []
+
+    def product_offer_v2_batch(self, searches: Sequence[Tuple[str, Any, int]], *,
+                               limit: int = 15) -> List[Optional[OfferPage]]:
+        """
+        Várias buscas productOfferV2 num único POST, uma por alias (q0, q1, ...).
+        searches: (tipo, valor, page) com tipo "keyword" ou "shopId".
+        Retorna uma OfferPage por busca, na mesma ordem; None onde o alias veio nulo (erro parcial).
+        """
+        if not searches:
+            return []
+        parts = [
+            f"q{i}: productOfferV2({_offer_args(kind, value, page, limit)}) "
+            f"{{ nodes {{ {_NODE_FIELDS} }} pageInfo {{ hasNextPage }} }}"
+            for i, (kind, value, page) in enumerate(searches)
+        ]
+        data = self._post_graphql_auto("query { " + " ".join(parts) + " }")
+        if data.get("errors"):
+            LOGGER.warning("GraphQL em lote retornou erros: %s", json.dumps(data["errors"], ensure_ascii=False)[:500])
+        block = data.get("data") or {}
+        out: List[Optional[OfferPage]] = []
+        for i in range(len(searches)):
+            conn = block.get(f"q{i}")
+            if conn is None:
+                out.append(None)
+                continue
+            nodes = conn.get("nodes") or []
+            info = conn.get("pageInfo") or {}
+            has_next = info.get("hasNextPage")
+            out.append(OfferPage(nodes, bool(has_next) if has_next is not None else len(nodes) >= int(limit)))
+        return out
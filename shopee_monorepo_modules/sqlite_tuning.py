@@ -0,0 +1,16 @@
+# shopee_monorepo_modules/sqlite_tuning.py — PRAGMAs de desempenho compartilhados por quem abre o SQLite
+from __future__ import annotations
+import sqlite3
+
+PERF_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # leitores não bloqueiam o escritor
+    "PRAGMA synchronous=NORMAL",     # fsync só no checkpoint (seguro com WAL)
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",    # 256 MiB de I/O mapeado em memória
+    "PRAGMA cache_size=-131072",     # 128 MiB de page cache
+)
+
+def apply_pragmas(con: sqlite3.Connection) -> sqlite3.Connection:
+    for pragma in PERF_PRAGMAS:
+        con.execute(pragma)
+    return con
@@ -50,6 +50,13 @@ CREATE TABLE IF NOT EXISTS conversion_items (
 );
 
 CREATE INDEX IF NOT EXISTS idx_conv_utm ON conversions(utm_content);
-CREATE INDEX IF NOT EXISTS idx_conv_item ON conversion_items(item_id);
-CREATE INDEX IF NOT EXISTS idx_conv_shop ON conversion_items(shop_name);
-CREATE INDEX IF NOT EXISTS idx_conv_cat ON conversion_items(globalCategoryLv1Name);
+-- índices de cobertura: agregados de EV sem visitar a tabela; substituem os de uma coluna
+-- (mesmo prefixo), que só custavam escrita a cada sync
+DROP INDEX IF EXISTS idx_conv_item;
+DROP INDEX IF EXISTS idx_conv_shop;
+DROP INDEX IF EXISTS idx_conv_cat;
+CREATE INDEX IF NOT EXISTS idx_ci_item_cid_amt ON conversion_items(item_id, conversion_id, item_total_commission);
+CREATE INDEX IF NOT EXISTS idx_ci_shop_cid_amt ON conversion_items(shop_name, conversion_id, item_total_commission);
+CREATE INDEX IF NOT EXISTS idx_ci_cat_cid_amt ON conversion_items(globalCategoryLv1Name, conversion_id, item_total_commission);
+-- conversion_id é o rowid (INTEGER PRIMARY KEY): toda entrada de índice já o carrega
+CREATE INDEX IF NOT EXISTS idx_conv_purchase ON conversions(purchase_time);
@@ -3,9 +3,10 @@
 storage.py — Camada de persistência (SQLite) para o bot Shopee → Telegram.
 """
 from __future__ import annotations
-import sqlite3, pathlib
+import sqlite3, pathlib, time
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from shopee_monorepo_modules.sqlite_tuning import apply_pragmas
 
 DB_PATH = "data/bot.db"
 
@@ -22,22 +23,53 @@ CREATE TABLE IF NOT EXISTS prices (
 CREATE TABLE IF NOT EXISTS posts (
   id INTEGER PRIMARY KEY AUTOINCREMENT, item_id INTEGER, variant TEXT, message_id TEXT, posted_at TEXT
 );
+CREATE TABLE IF NOT EXISTS ia_cache (
+  h TEXT PRIMARY KEY, item_id INTEGER, pontuacao REAL, texto_a TEXT, texto_b TEXT, ts REAL
+);
 CREATE INDEX IF NOT EXISTS idx_prices_item ON prices(item_id);
-CREATE INDEX IF NOT EXISTS idx_posts_item ON posts(item_id);
+DROP INDEX IF EXISTS idx_posts_item;  -- prefixo redundante de idx_posts_item_posted
+CREATE INDEX IF NOT EXISTS idx_posts_item_posted ON posts(item_id, posted_at DESC);
 """
 
 def _utcnow_iso(): return datetime.utcnow().isoformat(timespec="seconds")
 
+def _executemany_tx(con: sqlite3.Connection, sql: str, rows: Sequence[Any], pre: Iterable[Tuple[str, Tuple[Any, ...]]] = ()) -> None:
+    """executemany numa transação só (um commit por lote); `pre` roda antes, na mesma transação."""
+    con.execute("BEGIN")
+    try:
+        for stmt, params in pre:
+            con.execute(stmt, params)
+        con.executemany(sql, rows)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
 class Storage:
     def __init__(self, db_path: str = DB_PATH) -> None:
         self.db_path = db_path
+        self._pending_posts: List[Tuple[int, str, Optional[str], str]] = []
+        self._con: Optional[sqlite3.Connection] = None
         pathlib.Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
         with self._conn() as con:
             con.executescript(SCHEMA)
-    def _conn(self):
-        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
-        con.row_factory = sqlite3.Row
-        return con
+    def _conn(self) -> sqlite3.Connection:
+        # uma conexão por instância (usada só pela thread principal): os PRAGMAs rodam uma vez,
+        # não a cada consulta; `with` sobre ela só faz commit/rollback, não fecha
+        if self._con is None:
+            con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            con.row_factory = sqlite3.Row
+            apply_pragmas(con)  # WAL + synchronous=NORMAL: record_post sem 2 fsyncs, leituras não bloqueiam
+            self._con = con
+        return self._con
+    def close(self) -> None:
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+    def optimize(self) -> None:
+        """PRAGMA optimize ao fim da execução (atualiza estatísticas do planner só onde vale a pena)."""
+        with self._conn() as con:
+            con.execute("PRAGMA optimize")
     def upsert_product(self, prod: Dict[str, Any]) -> None:
         now = _utcnow_iso()
         with self._conn() as con:
@@ -75,16 +107,66 @@ class Storage:
     def record_post(self, item_id: int, variant: str, message_id: str) -> None:
         with self._conn() as con:
             con.execute("INSERT INTO posts (item_id, variant, message_id, posted_at) VALUES (?, ?, ?, ?)", (item_id, variant, message_id, _utcnow_iso()))
+    def queue_post(self, item_id: int, variant: str, message_id: Optional[str], flush_every: int = 10) -> None:
+        """Como record_post, mas acumula (horário do post preservado) e grava em lote a cada `flush_every`."""
+        self._pending_posts.append((item_id, variant, message_id, _utcnow_iso()))
+        if len(self._pending_posts) >= flush_every:
+            self.flush_posts()
+    def flush_posts(self) -> None:
+        if not self._pending_posts: return
+        with self._conn() as con:
+            _executemany_tx(con, "INSERT INTO posts (item_id, variant, message_id, posted_at) VALUES (?, ?, ?, ?)", self._pending_posts)
+        self._pending_posts.clear()
     def last_posted_at(self, item_id: int) -> Optional[str]:
         with self._conn() as con:
             row = con.execute("SELECT posted_at FROM posts WHERE item_id=? ORDER BY posted_at DESC LIMIT 1", (item_id,)).fetchone()
         return str(row["posted_at"]) if row else None
+    def last_posted_map(self, item_ids: Iterable[int], chunk: int = 500) -> Dict[int, str]:
+        """Último posted_at de vários itens com uma query por bloco de ids (em vez de uma por item)."""
+        ids = list(dict.fromkeys(int(i) for i in item_ids if i))
+        out: Dict[int, str] = {}
+        with self._conn() as con:
+            for k in range(0, len(ids), chunk):
+                part = ids[k:k + chunk]
+                rows = con.execute(
+                    f"SELECT item_id, MAX(posted_at) AS last FROM posts WHERE item_id IN ({','.join('?' * len(part))}) GROUP BY item_id",
+                    part,
+                ).fetchall()
+                out.update((int(r["item_id"]), str(r["last"])) for r in rows if r["last"] is not None)
+        return out
+    def ia_cache_get_many(self, hashes: Iterable[str], max_age_s: float, chunk: int = 500) -> Dict[str, Dict[str, Any]]:
+        """Resultados de IA ainda válidos (ts dentro de max_age_s) por hash de conteúdo do produto."""
+        keys = list(dict.fromkeys(hashes))
+        min_ts = time.time() - max_age_s
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._conn() as con:
+            for k in range(0, len(keys), chunk):
+                part = keys[k:k + chunk]
+                rows = con.execute(
+                    f"SELECT h, pontuacao, texto_a, texto_b FROM ia_cache WHERE ts >= ? AND h IN ({','.join('?' * len(part))})",
+                    [min_ts, *part],
+                ).fetchall()
+                for r in rows:
+                    out[r["h"]] = {"texto_de_venda_a": r["texto_a"], "texto_de_venda_b": r["texto_b"], "pontuacao": float(r["pontuacao"])}
+        return out
+    def ia_cache_put_many(self, entries: Iterable[Tuple[str, int, Dict[str, Any]]], max_age_s: Optional[float] = None) -> None:
+        """entries: (hash, item_id, {"pontuacao", "texto_de_venda_a", "texto_de_venda_b"}).
+        Com max_age_s, apaga na mesma transação as entradas já vencidas (a tabela não cresce sem fim)."""
+        now = time.time()
+        rows = [(h, iid, ia.get("pontuacao"), ia.get("texto_de_venda_a"), ia.get("texto_de_venda_b"), now) for h, iid, ia in entries]
+        if not rows: return
+        prune = [("DELETE FROM ia_cache WHERE ts < ?", (now - max_age_s,))] if max_age_s is not None else []
+        with self._conn() as con:
+            _executemany_tx(con, "INSERT OR REPLACE INTO ia_cache (h, item_id, pontuacao, texto_a, texto_b, ts) VALUES (?, ?, ?, ?, ?, ?)", rows, pre=prune)
     def can_repost(self, item_id: int, cooldown_days: int) -> bool:
-        last = self.last_posted_at(item_id)
-        if not last: return True
-        try: from datetime import datetime as _dt; last_dt = _dt.fromisoformat(last)
-        except Exception: return True
-        from datetime import datetime as _dt; return _dt.utcnow() >= last_dt + timedelta(days=cooldown_days)
+        return cooldown_ok(self.last_posted_at(item_id), cooldown_days)
+
+def cooldown_ok(last: Optional[str], cooldown_days: int) -> bool:
+    """True se não há post anterior ou se o cooldown (em dias) desde `last` (ISO, UTC) já passou."""
+    if not last: return True
+    try: last_dt = datetime.fromisoformat(last)
+    except Exception: return True
+    return datetime.utcnow() >= last_dt + timedelta(days=cooldown_days)
 
 def _to_float(v):
     if v is None: return None